@@ -1,3 +1,7 @@
+import time
+# time-to-first-paint is measured from here, see LedgerApp.paintEvent
+STARTED = time.perf_counter()
+
 import sys
 import sqlite3
 from typing import override
@@ -5,43 +9,423 @@ from PySide6.QtWidgets import (
     QApplication, QWidget, QVBoxLayout, QPushButton, QTabWidget,
     QTableWidget, QTableWidgetItem, QHBoxLayout, QLineEdit, QFormLayout,
     QDialog, QDialogButtonBox, QLabel, QMessageBox, QDateEdit, QComboBox, 
-    QHeaderView, QFrame, QTreeWidget, QTreeWidgetItem, QSizePolicy, QSpacerItem,
-    QFileDialog, QTextEdit
+    QHeaderView, QFrame, QTreeView,
+    QFileDialog, QPlainTextEdit, QTableView, QStyledItemDelegate, QStyleOptionButton, QStyle, QMenu, QProgressDialog,
+    QCheckBox, QInputDialog
 )
+from PySide6.QtGui import QStandardItemModel, QStandardItem
 from PySide6.QtGui import QDoubleValidator, QFont, QDropEvent, QDragMoveEvent, QDragEnterEvent, QDragLeaveEvent, QDrag
-from PySide6.QtCore import Qt
+from PySide6.QtCore import Qt, QAbstractTableModel, QModelIndex, QEvent, QRect, QSize, QRunnable, QThreadPool
 from PySide6.QtCore import QDate
-from PySide6.QtCore import QObject, Signal
-from PySide6.QtGui import QTextCursor
+from PySide6.QtCore import QObject, Signal, QTimer, QEventLoop
 
 from collections import defaultdict
-from functools import partial
+from contextlib import contextmanager
+from functools import partial, lru_cache
+from itertools import accumulate, chain, product
+from collections import deque
+import argparse
+import csv
+import datetime
 import decimal
+import gc
+import json
+import os
 import sys
-import openpyxl
+import pathlib
+import queue
+import random
+import tempfile
+import threading
 import traceback
 
-class LoggingCursor(sqlite3.Cursor):
+DB_PATH = "ledger.db"
+
+# the writer connection and its cursor, set by open_db
+conn = None
+cursor = None
+
+TRACE_OFF = 0
+TRACE_SQL = 1
+TRACE_TIMING = 2
+
+class TimingCursor(sqlite3.Cursor):
     def execute(self, sql, params=()):
-        print(f"[SQL] {sql.strip()}")
-        print(f"    | params: {params}")
-        return super().execute(sql, params)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            sql_tracer.record(sql, params, time.perf_counter() - start)
 
-class LoggingConnection(sqlite3.Connection):
-    def cursor(self, *args, **kwargs):
-        return super().cursor(factory=LoggingCursor)
+    def executemany(self, sql, seq_of_params):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_params)
+        finally:
+            sql_tracer.record(sql, '<many>', time.perf_counter() - start)
 
-conn = sqlite3.connect("ledger.db", factory=LoggingConnection)
-cursor = conn.cursor()
+class SqlTracer(QObject):
+    """
+    off: plain cursor and no callback, nothing is paid per statement
+    sql: sqlite reports every statement, trigger bodies included
+    timing: the module cursor is swapped for a TimingCursor
+    records land in a ring buffer that DebugTab shows. Readers trace on the
+    worker threads too, so the buffer is locked and recorded is emitted once
+    per batch of records until the next snapshot()
+    """
+    recorded = Signal()
 
-def init_db(drop):
-    cursor.execute("PRAGMA foreign_keys = ON")
+    def __init__(self, size=1000):
+        super().__init__()
+        self.level = TRACE_OFF
+        self.records = deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.notified = False
+
+    def set_level(self, level):
+        global cursor
+        self.level = level
+        self.attach(conn)
+        cursor = self.cursor(conn)
+
+    def attach(self, connection):
+        connection.set_trace_callback(self.trace if self.level == TRACE_SQL else None)
+
+    def cursor(self, connection):
+        return connection.cursor(TimingCursor) if self.level == TRACE_TIMING else connection.cursor()
+
+    def trace(self, sql):
+        self.append((time.time(), None, sql, None))
+
+    def record(self, sql, params, duration):
+        self.append((time.time(), duration, sql.strip(), params))
+
+    def append(self, record):
+        with self.lock:
+            self.records.append(record)
+            notify = not self.notified
+            self.notified = True
+        if notify:
+            # queued to the GUI thread when emitted from a worker
+            self.recorded.emit()
+
+    def snapshot(self):
+        with self.lock:
+            self.notified = False
+            return list(self.records)
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+
+sql_tracer = SqlTracer()
+
+class ConnectionManager:
+    """
+    one writer connection, used on the GUI thread, and a pool of read-only
+    connections no larger than the thread pool. A worker task borrows one
+    for its whole run (see borrow). In WAL mode readers see the last commit
+    and neither block nor are blocked by the writer
+    """
 
+    PRAGMAS = [
+        # 64MB page cache, negative means KiB
+        "PRAGMA cache_size = -65536",
+        "PRAGMA mmap_size = 268435456",
+        "PRAGMA temp_store = MEMORY",
+    ]
+
+    def __init__(self, path):
+        self.path = path
+        # QThreadPool threads drop thread-local state between runs, so the
+        # borrowed reader is looked up by thread id instead
+        self.borrowed = {}
+        self.idle = queue.Queue()
+        self.readers = []
+        self.size = QThreadPool.globalInstance().maxThreadCount()
+        self.lock = threading.Lock()
+        self.writer = sqlite3.connect(path)
+        self.writer.execute("PRAGMA journal_mode = WAL")
+        # with WAL, NORMAL syncs at checkpoints only, so a commit no longer
+        # waits on fsync; a power cut may lose the last commits but never
+        # corrupts the file
+        self.writer.execute("PRAGMA synchronous = NORMAL")
+        self.writer.execute("PRAGMA foreign_keys = ON")
+        self.configure(self.writer)
+
+    def configure(self, connection):
+        for pragma in self.PRAGMAS:
+            connection.execute(pragma)
+        sql_tracer.attach(connection)
+
+    def reader(self):
+        if threading.current_thread() is threading.main_thread():
+            return self.writer
+        connection = self.borrowed.get(threading.get_ident())
+        if connection is None:
+            raise RuntimeError('worker reads must run inside db.borrow()')
+        return connection
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if len(self.readers) < self.size:
+                uri = pathlib.Path(self.path).absolute().as_uri() + "?mode=ro"
+                # a reader moves between pool threads, one task at a time
+                connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+                self.configure(connection)
+                self.readers.append(connection)
+                return connection
+        return self.idle.get()
+
+    @contextmanager
+    def borrow(self):
+        """lend a reader to the calling worker thread until the block ends"""
+        connection = self.acquire()
+        # the trace level may have changed since the reader was last lent
+        sql_tracer.attach(connection)
+        self.borrowed[threading.get_ident()] = connection
+        try:
+            yield connection
+        finally:
+            del self.borrowed[threading.get_ident()]
+            self.idle.put(connection)
+
+    def close(self):
+        with self.lock:
+            for connection in self.readers:
+                connection.close()
+            self.readers.clear()
+        self.writer.close()
+
+db = None
+
+def open_db(path=DB_PATH):
+    global db, conn, cursor
+    if db:
+        db.close()
+    db = ConnectionManager(path)
+    conn = db.writer
+    cursor = conn.cursor()
+    changes.reset()
+    # keep the tracer attached to the new connection
+    sql_tracer.set_level(sql_tracer.level)
+
+def read_connection():
+    return db.reader()
+
+def read_cursor():
+    if threading.current_thread() is threading.main_thread():
+        return cursor
+    return sql_tracer.cursor(read_connection())
+
+def create_transfer_table(name):
+    # amount is stored in cents, see amount_to_cents
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {name} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            time TEXT NOT NULL,
+            person INTEGER NOT NULL,
+            sub_project INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            amount INTEGER NOT NULL,
+            memo TEXT,
+            FOREIGN KEY (person) REFERENCES person(id) ON DELETE RESTRICT,
+            FOREIGN KEY (sub_project) REFERENCES sub_project(id) ON DELETE RESTRICT
+        )
+    """)
+
+SCHEMA_VERSION = 10
+MIGRATION_BATCH_SIZE = 10000
+
+def migrate_amount_to_cents():
+    amount_type = cursor.execute("SELECT type FROM pragma_table_info('transfer') WHERE name = 'amount'").fetchone()[0]
+    if amount_type.upper() == 'INTEGER':
+        return
+
+    # copy into transfer_new batch by batch, committing in between so that an
+    # interrupted migration resumes from the last copied id on next start
+    create_transfer_table("transfer_new")
+    conn.commit()
+    last_id = cursor.execute("SELECT MAX(id) FROM transfer_new").fetchone()[0] or 0
+    while True:
+        rows = cursor.execute("""
+            SELECT id, time, person, sub_project, kind, amount, memo
+            FROM transfer WHERE id > ? ORDER BY id LIMIT ?
+        """, (last_id, MIGRATION_BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        cursor.executemany(
+            "INSERT INTO transfer_new (id, time, person, sub_project, kind, amount, memo) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(id_, time, person, sub_project, kind, amount_to_cents(amount), memo) for (id_, time, person, sub_project, kind, amount, memo) in rows])
+        conn.commit()
+        last_id = rows[-1][0]
+        print('migrated transfer up to id', last_id)
+
+    try:
+        cursor.execute('BEGIN')
+        cursor.execute("DROP TABLE transfer")
+        cursor.execute("ALTER TABLE transfer_new RENAME TO transfer")
+        # balance amounts were decimal text as well, init_db rebuilds it
+        cursor.execute("DROP TABLE IF EXISTS balance")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def create_indexes():
+    # transfer_list_idx covers the list view and its (time, id) keyset
+    # ordering, so there is no separate index on time alone
+    create_transfer_list_index()
+    create_pair_time_index()
+    cursor.execute("CREATE INDEX IF NOT EXISTS transfer_sub_project_idx ON transfer (sub_project)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS sub_project_parent_idx ON sub_project (parent, rank)")
+
+def create_transfer_list_index():
+    cursor.execute("CREATE INDEX IF NOT EXISTS transfer_list_idx ON transfer (time, id, person, sub_project, kind, amount, memo)")
+
+def create_pair_time_index():
+    # one pair's timeline in (time, id) order with what its running balance
+    # needs, see RUNNING_BALANCE_CHECK_SQL
+    cursor.execute("CREATE INDEX IF NOT EXISTS transfer_pair_time_idx ON transfer (person, sub_project, time, id, kind, amount)")
+
+def create_kind_index():
+    # a kind filter seeks here and reads its rows already in list order
+    cursor.execute("CREATE INDEX IF NOT EXISTS transfer_kind_idx ON transfer (kind, time, id)")
+
+def create_amount_index():
+    cursor.execute("CREATE INDEX IF NOT EXISTS transfer_amount_idx ON transfer (amount)")
+
+def create_project_rank_index():
+    cursor.execute("CREATE INDEX IF NOT EXISTS project_rank_idx ON project (rank)")
+
+def spread_ranks():
+    # ranks were consecutive before RANK_GAP, space them out once
+    cursor.execute(f"""
+        UPDATE project SET rank = ordered.n * {RANK_GAP}
+        FROM (SELECT id, ROW_NUMBER() OVER (ORDER BY rank, id) AS n FROM project) AS ordered
+        WHERE project.id = ordered.id
+    """)
+    cursor.execute(f"""
+        UPDATE sub_project SET rank = ordered.n * {RANK_GAP}
+        FROM (SELECT id, ROW_NUMBER() OVER (PARTITION BY parent ORDER BY rank, id) AS n FROM sub_project) AS ordered
+        WHERE sub_project.id = ordered.id
+    """)
+
+TRANSFER_FTS_INSERT_TRIGGER = """
+    CREATE TRIGGER IF NOT EXISTS transfer_fts_insert AFTER INSERT ON transfer BEGIN
+        INSERT INTO transfer_fts (rowid, memo, person, project, sub_project)
+        SELECT NEW.id, NEW.memo, person.name, project.name, sub_project.name
+        FROM sub_project
+        JOIN project ON sub_project.parent = project.id
+        JOIN person ON person.id = NEW.person
+        WHERE sub_project.id = NEW.sub_project;
+    END
+"""
+
+TRANSFER_FTS_FILL_SQL = """
+    INSERT INTO transfer_fts (rowid, memo, person, project, sub_project)
+    SELECT transfer.id, transfer.memo, person.name, project.name, sub_project.name
+    FROM transfer
+    JOIN person ON transfer.person = person.id
+    JOIN sub_project ON transfer.sub_project = sub_project.id
+    JOIN project ON sub_project.parent = project.id
+    WHERE transfer.id > ?
+"""
+
+def create_transfer_fts():
+    # full text index over memo and the names a transfer points to. trigram
+    # tokenizing lets a query match inside words, which is also what makes
+    # it work for Chinese text without word boundaries
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS transfer_fts
+        USING fts5(memo, person, project, sub_project, tokenize = 'trigram')
+    """)
+    cursor.execute(TRANSFER_FTS_INSERT_TRIGGER)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS transfer_fts_delete AFTER DELETE ON transfer BEGIN
+            DELETE FROM transfer_fts WHERE rowid = OLD.id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS transfer_fts_update AFTER UPDATE OF memo, person, sub_project ON transfer BEGIN
+            DELETE FROM transfer_fts WHERE rowid = OLD.id;
+            INSERT INTO transfer_fts (rowid, memo, person, project, sub_project)
+            SELECT NEW.id, NEW.memo, person.name, project.name, sub_project.name
+            FROM sub_project
+            JOIN project ON sub_project.parent = project.id
+            JOIN person ON person.id = NEW.person
+            WHERE sub_project.id = NEW.sub_project;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS person_fts_rename AFTER UPDATE OF name ON person BEGIN
+            UPDATE transfer_fts SET person = NEW.name
+            WHERE rowid IN (SELECT id FROM transfer WHERE person = NEW.id);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS project_fts_rename AFTER UPDATE OF name ON project BEGIN
+            UPDATE transfer_fts SET project = NEW.name
+            WHERE rowid IN (SELECT id FROM transfer WHERE sub_project IN (SELECT id FROM sub_project WHERE parent = NEW.id));
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS sub_project_fts_rename AFTER UPDATE OF name ON sub_project BEGIN
+            UPDATE transfer_fts SET sub_project = NEW.name
+            WHERE rowid IN (SELECT id FROM transfer WHERE sub_project = NEW.id);
+        END
+    """)
+    cursor.execute("DELETE FROM transfer_fts")
+    cursor.execute(TRANSFER_FTS_FILL_SQL, (0,))
+
+def migrate_db():
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    if version < 1:
+        migrate_amount_to_cents()
+    if version < 2:
+        create_indexes()
+    if version < 3:
+        # balance gained income and spend, init_db recreates and rebuilds it
+        cursor.execute("DROP TABLE IF EXISTS balance")
+    if version < 4:
+        create_amount_index()
+    if version < 5:
+        create_transfer_fts()
+    if version >= 2 and version < 6:
+        # id joined time in transfer_list_idx for keyset paging
+        cursor.execute("DROP INDEX IF EXISTS transfer_list_idx")
+        create_transfer_list_index()
+    if version < 7:
+        create_project_rank_index()
+        spread_ranks()
+    if version >= 2 and version < 8:
+        # time joined (person, sub_project) for the running balance check
+        cursor.execute("DROP INDEX IF EXISTS transfer_person_sub_project_idx")
+        create_pair_time_index()
+    if version < 9:
+        create_kind_index()
+    if version < 10:
+        # balance_snapshot went from every pair in every closed month to only
+        # the months a pair changed in, init_db recreates and refills it
+        cursor.execute("DROP TABLE IF EXISTS balance_snapshot")
+    cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    conn.commit()
+
+def init_db(drop):
     if drop:
         cursor.execute("DROP TABLE IF EXISTS person")
         cursor.execute("DROP TABLE IF EXISTS project")
         cursor.execute("DROP TABLE IF EXISTS sub_project")
         cursor.execute("DROP TABLE IF EXISTS transfer")
+        cursor.execute("DROP TABLE IF EXISTS balance")
+        cursor.execute("DROP TABLE IF EXISTS balance_snapshot")
+        cursor.execute("DROP TABLE IF EXISTS transfer_fts")
+        cursor.execute("PRAGMA user_version = 0")
+        changes.publish(*TABLES)
 
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS person (
@@ -68,117 +452,311 @@ def init_db(drop):
             FOREIGN KEY (parent) REFERENCES project(id) ON DELETE RESTRICT
         )
     """)
+    create_transfer_table("transfer")
+    conn.commit()
+
+    migrate_db()
+
+    # balance keeps the running total of every (person, sub_project) pair so
+    # that the balance check after a write is a primary key lookup instead of
+    # a scan over transfer
+    has_balance = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'balance'").fetchone()
+    has_snapshot = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'balance_snapshot'").fetchone()
     cursor.execute("""
-        CREATE TABLE IF NOT EXISTS transfer (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            time TEXT NOT NULL,
+        CREATE TABLE IF NOT EXISTS balance (
             person INTEGER NOT NULL,
             sub_project INTEGER NOT NULL,
-            kind TEXT NOT NULL,
-            amount TEXT NOT NULL,
-            memo TEXT,
-            FOREIGN KEY (person) REFERENCES person(id) ON DELETE RESTRICT,
-            FOREIGN KEY (sub_project) REFERENCES sub_project(id) ON DELETE RESTRICT
-        )
+            amount INTEGER NOT NULL,
+            income INTEGER NOT NULL,
+            spend INTEGER NOT NULL,
+            PRIMARY KEY (person, sub_project)
+        ) WITHOUT ROWID
+    """)
+    # balance_snapshot holds the balance of a pair as of the end of every
+    # month the pair has transfers in, see balance_as_of
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS balance_snapshot (
+            person INTEGER NOT NULL,
+            sub_project INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            amount INTEGER NOT NULL,
+            income INTEGER NOT NULL,
+            spend INTEGER NOT NULL,
+            PRIMARY KEY (person, sub_project, month)
+        ) WITHOUT ROWID
     """)
     conn.commit()
+    if not has_balance:
+        rebuild_balance()
+    elif not has_snapshot:
+        rebuild_snapshots()
+
+class Dimensions:
+    """
+    one snapshot of person, project and sub_project: the ordered lists and
+    name <-> id maps both ways. Never modified once built
+    """
+
+    def __init__(self, persons, projects, sub_projects):
+        # persons [(id, name)], projects [(id, name)] by rank,
+        # sub_projects [(id, name, project_id)] by project rank then rank
+        self.persons = persons
+        self.person_ids = {name: id_ for id_, name in persons}
+        self.person_names = dict(persons)
+        self.projects = projects
+        self.project_ids = {name: id_ for id_, name in projects}
+        self.project_names = dict(projects)
+        self.sub_projects = defaultdict(list)
+        self.sub_project_ids = {}
+        self.sub_project_names = {}
+        for id_, name, project_id in sub_projects:
+            self.sub_projects[project_id].append((id_, name))
+            self.sub_project_ids[(project_id, name)] = id_
+            self.sub_project_names[id_] = name
+
+    def ordered_sub_projects(self):
+        """yield (sub_project_id, project_name, sub_project_name) in display order"""
+        for project_id, project in self.projects:
+            for sub_project_id, sub_project in self.sub_projects.get(project_id, []):
+                yield sub_project_id, project, sub_project
+
+class DimensionCache:
+    """
+    Dimensions loaded on first use and dropped by every dimension write
+    (it listens on changes). A load racing a write is discarded through
+    version, so a worker thread can never put back a stale snapshot
+    """
+
+    def __init__(self):
+        self.dimensions = None
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        dimensions = self.dimensions
+        if dimensions is not None:
+            return dimensions
+        with self.lock:
+            version = self.version
+        cur = read_cursor()
+        dimensions = Dimensions(
+            cur.execute("SELECT id, name FROM person ORDER BY id").fetchall(),
+            cur.execute("SELECT id, name FROM project ORDER BY rank").fetchall(),
+            cur.execute("""
+                SELECT sub_project.id, sub_project.name, sub_project.parent
+                FROM sub_project JOIN project ON sub_project.parent = project.id
+                ORDER BY project.rank ASC, sub_project.rank ASC
+            """).fetchall())
+        with self.lock:
+            if version == self.version:
+                self.dimensions = dimensions
+        return dimensions
+
+    def invalidate(self):
+        with self.lock:
+            self.version += 1
+            self.dimensions = None
+
+dimension_cache = DimensionCache()
+
+TABLES = ("person", "project", "sub_project", "transfer")
+
+class ChangeBus:
+    """
+    a change counter per table. Every write publishes the tables it touched
+    once committed and the listeners subscribed to them run right away. A
+    tab keeps the versions() it rendered and skips reloading while they
+    stay the same. Commits from another process are caught through
+    PRAGMA data_version, which only moves for other connections
+    """
+
+    def __init__(self):
+        self.counters = dict.fromkeys(TABLES, 0)
+        self.listeners = defaultdict(list)
+        self.data_version = None
+
+    def subscribe(self, tables, listener):
+        for table in tables:
+            self.listeners[table].append(listener)
+
+    def publish(self, *tables):
+        for table in tables:
+            self.counters[table] += 1
+        for listener in dict.fromkeys(listener for table in tables for listener in self.listeners[table]):
+            listener()
+
+    def versions(self, *tables):
+        self.poll()
+        return tuple(self.counters[table] for table in tables)
+
+    def poll(self):
+        # main thread only, conn is the writer
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if self.data_version is not None and version != self.data_version:
+            self.publish(*TABLES)
+        self.data_version = version
+
+    def reset(self):
+        # a new connection starts its own data_version
+        self.data_version = None
+        self.publish(*TABLES)
+
+changes = ChangeBus()
+changes.subscribe(("person", "project", "sub_project"), dimension_cache.invalidate)
 
 def get_person():
-    cursor.execute("SELECT id, name FROM person")
-    return cursor.fetchall()
+    return dimension_cache.get().persons
 
 def get_person_name(id):
-    cursor.execute("SELECT name FROM person WHERE id = ?", (id,))
-    return cursor.fetchone()[0]
+    return dimension_cache.get().person_names[id]
 
 def get_project():
-    cursor.execute("SELECT id, name FROM project ORDER BY rank")
-    return cursor.fetchall()
+    return dimension_cache.get().projects
+
+# ranks of siblings start RANK_GAP apart, so a move can nearly always take a
+# rank between its new neighbours and write the moved rows only
+RANK_GAP = 1024
+
+def rank_scope(parent):
+    """WHERE clause and params selecting the siblings, sub_projects of parent or all projects"""
+    return ("parent = ?", (parent,)) if parent is not None else ("1", ())
+
+def swap_ranks(table, parent, name1, name2):
+    scope, params = rank_scope(parent)
+    try:
+        cursor.execute("BEGIN")
+        ranks = dict(cursor.execute(
+            f"SELECT name, rank FROM {table} WHERE {scope} AND name IN (?, ?)", (*params, name1, name2)).fetchall())
+        cursor.execute(
+            f"UPDATE {table} SET rank = CASE name WHEN ? THEN ? ELSE ? END WHERE {scope} AND name IN (?, ?)",
+            (name1, ranks[name2], ranks[name1], *params, name1, name2))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    changes.publish(table)
+
+def move_ranked(table, parent, names, before=None):
+    """
+    move names, in the given order, right ahead of before (None for the
+    end) among the siblings in table. The neighbour ranks come from index
+    lookups and only the moved rows are written, unless the gap is used up
+    and the siblings get renumbered RANK_GAP apart
+    """
+    scope, params = rank_scope(parent)
+    if not names:
+        return
+    if before in names:
+        raise InvalidInputError(f'{before} 不能移到自己前面')
+    moving = ', '.join('?' * len(names))
+    try:
+        cursor.execute("BEGIN")
+        # ORDER BY ... LIMIT 1 walks the rank index backwards and stops at
+        # the first row that is not moving
+        if before is None:
+            high = None
+            item = cursor.execute(
+                f"SELECT rank FROM {table} WHERE {scope} AND name NOT IN ({moving}) ORDER BY rank DESC LIMIT 1",
+                (*params, *names)).fetchone()
+        else:
+            item = cursor.execute(f"SELECT rank FROM {table} WHERE {scope} AND name = ?", (*params, before)).fetchone()
+            if item is None:
+                raise InvalidInputError(f'{before} 不存在')
+            high = item[0]
+            item = cursor.execute(
+                f"SELECT rank FROM {table} WHERE {scope} AND rank < ? AND name NOT IN ({moving}) ORDER BY rank DESC LIMIT 1",
+                (*params, high, *names)).fetchone()
+        low = item[0] if item else 0
+
+        step = RANK_GAP if high is None else (high - low) // (len(names) + 1)
+        if step > 0:
+            ranks = [(low + step * (i + 1), name) for i, name in enumerate(names)]
+        else:
+            rest = [name for (name,) in cursor.execute(
+                f"SELECT name FROM {table} WHERE {scope} AND name NOT IN ({moving}) ORDER BY rank", (*params, *names)).fetchall()]
+            index = rest.index(before)
+            order = rest[:index] + list(names) + rest[index:]
+            ranks = [(RANK_GAP * (i + 1), name) for i, name in enumerate(order)]
+
+        for rank, name in ranks:
+            cursor.execute(f"UPDATE {table} SET rank = ? WHERE {scope} AND name = ?", (rank, *params, name))
+            if cursor.rowcount != 1:
+                raise InvalidInputError(f'{name} 不存在')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    changes.publish(table)
+
+def move_projects(names, before=None):
+    move_ranked("project", None, names, before)
+
+def move_sub_projects(parent, names, before=None):
+    move_ranked("sub_project", parent, names, before)
 
 def swap_project_order(name1, name2):
-    cursor.execute("SELECT rank FROM project WHERE name = ?", (name1,))
-    rank1 = cursor.fetchone()[0]
-    cursor.execute("SELECT rank FROM project WHERE name = ?", (name2,))
-    rank2 = cursor.fetchone()[0]
-
-    cursor.execute("BEGIN")
-    cursor.execute("UPDATE project SET rank = ? WHERE name = ?", (rank2, name1))
-    cursor.execute("UPDATE project SET rank = ? WHERE name = ?", (rank1, name2))
-    conn.commit()
+    swap_ranks("project", None, name1, name2)
 
 def get_sub_project(parent=None):
+    dimensions = dimension_cache.get()
     if parent != None:
-        cursor.execute("SELECT id FROM project WHERE name = ?", (parent,))
-        item = cursor.fetchone()
-        if item is None:
+        parent_id = dimensions.project_ids.get(parent)
+        if parent_id is None:
             return []
-        parent_id = item[0]
-        cursor.execute("""
-            SELECT sub_project.name AS name, project.name AS parent
-            FROM sub_project LEFT JOIN project ON sub_project.parent = project.id
-            WHERE parent = ?
-            ORDER BY project.rank ASC, sub_project.rank ASC
-        """, (parent_id,))
-    else:
-        cursor.execute("""
-            SELECT sub_project.name AS name, project.name AS parent
-            FROM sub_project LEFT JOIN project ON sub_project.parent = project.id
-            ORDER BY project.rank ASC, sub_project.rank ASC
-        """)
-    return cursor.fetchall()
+        return [(name, parent) for _, name in dimensions.sub_projects.get(parent_id, [])]
+    return [(sub_project, project) for _, project, sub_project in dimensions.ordered_sub_projects()]
 
 
 def swap_sub_project_order(parent, name1, name2):
-    cursor.execute("SELECT rank FROM sub_project WHERE name = ? AND parent = ?", (name1, parent))
-    rank1 = cursor.fetchone()[0]
-    cursor.execute("SELECT rank FROM sub_project WHERE name = ? AND parent = ?", (name2, parent))
-    rank2 = cursor.fetchone()[0]
-
-    cursor.execute("BEGIN")
-    cursor.execute("UPDATE sub_project SET rank = ? WHERE name = ? AND parent = ?", (rank2, name1, parent))
-    cursor.execute("UPDATE sub_project SET rank = ? WHERE name = ? AND parent = ?", (rank1, name2, parent))
-    conn.commit()
+    swap_ranks("sub_project", parent, name1, name2)
 
 def add_person(name):
     if name:
         cursor.execute("INSERT INTO person (name) VALUES (?)", (name,))
         conn.commit()
+        changes.publish("person")
 
 def update_person(person_id, name):
     if name:
         cursor.execute("UPDATE person SET name = ? WHERE id = ?", (name, person_id))
         conn.commit()
+        changes.publish("person")
 
 def add_project(name):
     if name:
         cursor.execute("SELECT MAX(rank) FROM project")
         item = cursor.fetchone()[0]
         max_rank = item if item else 0
-        cursor.execute("INSERT INTO project (name, rank) VALUES (?, ?)", (name, max_rank + 1))
+        cursor.execute("INSERT INTO project (name, rank) VALUES (?, ?)", (name, max_rank + RANK_GAP))
         conn.commit()
+        changes.publish("project")
 
 def update_project(name, new_name):
     if new_name:
         cursor.execute("UPDATE project SET name = ? WHERE name = ?", (new_name, name))
         conn.commit()
+        changes.publish("project")
 
 def add_sub_project(name, parent):
     if name:
         cursor.execute("SELECT MAX(rank) FROM sub_project WHERE parent = ?", (parent,))
         item = cursor.fetchone()[0]
         max_rank = item if item else 0
-        cursor.execute("INSERT INTO sub_project (name, parent, rank) VALUES (?, ?, ?)", (name, parent, max_rank + 1))
+        cursor.execute("INSERT INTO sub_project (name, parent, rank) VALUES (?, ?, ?)", (name, parent, max_rank + RANK_GAP))
         conn.commit()
+        changes.publish("sub_project")
 
 def update_sub_project(parent, name, new_name):
     if new_name:
         cursor.execute("UPDATE sub_project SET name = ? WHERE parent = ? AND name = ?", (new_name, parent, name))
         conn.commit()
+        changes.publish("sub_project")
 
 def delete_person(person):
     try:
         cursor.execute("DELETE FROM person WHERE name=?", (person,))
         conn.commit()
+        changes.publish("person")
     except Exception as e:
         conn.rollback()
         raise
@@ -187,6 +765,7 @@ def delete_project(project):
     try:
         cursor.execute("DELETE FROM project WHERE name=?", (project,))
         conn.commit()
+        changes.publish("project")
     except Exception as e:
         conn.rollback()
         raise
@@ -195,6 +774,7 @@ def delete_sub_project(project, sub_project):
     try:
         cursor.execute("DELETE FROM sub_project WHERE parent=? AND name=?", (project, sub_project))
         conn.commit()
+        changes.publish("sub_project")
     except Exception as e:
         conn.rollback()
         raise
@@ -205,94 +785,387 @@ class InvalidInputError(Exception):
 class BalanceError(Exception):
     pass
 
-def kind_sign(kind):
-    return 1 if kind == '入账' else -1
+AMOUNT_SCALE = 100
 
-def get_balance(person, project):
-    cursor.execute("""
-        SELECT sub_project.name, transfer.amount, transfer.kind
-        FROM transfer
-        LEFT JOIN person ON transfer.person = person.id
-        LEFT JOIN sub_project ON transfer.sub_project = sub_project.id
-        LEFT JOIN project ON sub_project.parent = project.id
-        WHERE person.name=? AND project.name=?
-    """, (person, project))
+def amount_to_cents(amount):
+    try:
+        value = decimal.Decimal(str(amount).strip())
+    except decimal.InvalidOperation:
+        raise InvalidInputError(f'金额 {amount} 无效')
+    if not value.is_finite():
+        raise InvalidInputError(f'金额 {amount} 无效')
+    return int((value * AMOUNT_SCALE).quantize(decimal.Decimal(1), rounding=decimal.ROUND_HALF_UP))
+
+def transfer_amount_to_cents(amount):
+    # the kind carries the direction, a transfer amount is always above zero
+    cents = amount_to_cents(amount)
+    if cents <= 0:
+        raise InvalidInputError(f'金额 {amount} 必须大于 0')
+    return cents
+
+def cents_to_amount(cents):
+    return decimal.Decimal(cents).scaleb(-2)
+
+def format_amount(cents):
+    return str(cents_to_amount(cents))
+
+GET_BALANCE_SQL = """
+    SELECT sub_project.name, balance.amount
+    FROM balance
+    JOIN person ON balance.person = person.id
+    JOIN sub_project ON balance.sub_project = sub_project.id
+    JOIN project ON sub_project.parent = project.id
+    WHERE person.name=? AND project.name=?
+    ORDER BY sub_project.rank
+"""
+
+BALANCE_BY_ID_SQL = "SELECT amount FROM balance WHERE person=? AND sub_project=?"
+
+def get_balance(person, project, as_of=None):
+    if as_of:
+        return get_balance_as_of(person, project, as_of)
+    sub_project_balance = defaultdict(decimal.Decimal)
+    for (sub_project, amount) in read_cursor().execute(GET_BALANCE_SQL, (person, project)).fetchall():
+        sub_project_balance[sub_project] = cents_to_amount(amount)
+    return sub_project_balance
+
+def get_balance_as_of(person, project, as_of):
+    dimensions = dimension_cache.get()
+    person_id = dimensions.person_ids.get(person)
+    project_id = dimensions.project_ids.get(project)
     sub_project_balance = defaultdict(decimal.Decimal)
-    for (sub_project, amount, kind) in cursor.fetchall():
-        sub_project_balance[sub_project] += kind_sign(kind) * decimal.Decimal(amount)
+    if person_id is None or project_id is None:
+        return sub_project_balance
+    balance = balance_as_of(as_of)
+    for sub_project_id, sub_project in dimensions.sub_projects.get(project_id, []):
+        if (person_id, sub_project_id) in balance:
+            sub_project_balance[sub_project] = cents_to_amount(balance[(person_id, sub_project_id)][0])
     return sub_project_balance
 
-def post_check_balance(person, project, sub_project):
-    balance = get_balance(person, project).get(sub_project, 0)
-    print('post check balance', balance)
+def get_balance_by_id(person_id, sub_project_id):
+    item = cursor.execute(BALANCE_BY_ID_SQL, (person_id, sub_project_id)).fetchone()
+    return item[0] if item else 0
+
+# the deltas of one write, summed per pair and month. A temp table lives on
+# the writer connection only
+BALANCE_DELTA_TABLE_SQL = """
+    CREATE TEMP TABLE IF NOT EXISTS balance_delta (
+        person INTEGER NOT NULL,
+        sub_project INTEGER NOT NULL,
+        month TEXT NOT NULL,
+        amount INTEGER NOT NULL,
+        income INTEGER NOT NULL,
+        spend INTEGER NOT NULL,
+        PRIMARY KEY (person, sub_project, month)
+    ) WITHOUT ROWID
+"""
+
+BALANCE_DELTA_UPSERT_SQL = """
+    INSERT INTO balance (person, sub_project, amount, income, spend)
+    SELECT person, sub_project, SUM(amount), SUM(income), SUM(spend)
+    FROM balance_delta WHERE true GROUP BY person, sub_project
+    ON CONFLICT (person, sub_project) DO UPDATE SET
+        amount = amount + excluded.amount,
+        income = income + excluded.income,
+        spend = spend + excluded.spend
+"""
+
+# a pair changed in a month it has no snapshot for gets one, carrying the
+# balance of its snapshot before
+SNAPSHOT_OPEN_SQL = """
+    INSERT INTO balance_snapshot (person, sub_project, month, amount, income, spend)
+    SELECT delta.person, delta.sub_project, delta.month,
+        COALESCE(before.amount, 0), COALESCE(before.income, 0), COALESCE(before.spend, 0)
+    FROM balance_delta AS delta
+    LEFT JOIN balance_snapshot AS before ON before.person = delta.person AND before.sub_project = delta.sub_project
+        AND before.month = (
+            SELECT MAX(month) FROM balance_snapshot
+            WHERE person = delta.person AND sub_project = delta.sub_project AND month < delta.month)
+    WHERE true
+    ON CONFLICT (person, sub_project, month) DO NOTHING
+"""
+
+# then every snapshot of a changed pair takes the deltas of its month and
+# the months before. CROSS JOIN keeps the walk on the few delta rows
+SNAPSHOT_SHIFT_SQL = """
+    UPDATE balance_snapshot SET
+        amount = balance_snapshot.amount + shift.amount,
+        income = balance_snapshot.income + shift.income,
+        spend = balance_snapshot.spend + shift.spend
+    FROM (
+        SELECT snapshot.person, snapshot.sub_project, snapshot.month,
+            SUM(delta.amount) AS amount, SUM(delta.income) AS income, SUM(delta.spend) AS spend
+        FROM balance_delta AS delta
+        CROSS JOIN balance_snapshot AS snapshot ON snapshot.person = delta.person AND snapshot.sub_project = delta.sub_project
+            AND snapshot.month >= delta.month
+        GROUP BY snapshot.person, snapshot.sub_project, snapshot.month
+    ) AS shift
+    WHERE balance_snapshot.person = shift.person AND balance_snapshot.sub_project = shift.sub_project
+        AND balance_snapshot.month = shift.month
+"""
+
+def apply_balance_deltas(deltas):
+    """
+    add {(person_id, sub_project_id, month): (amount, income, spend)} to
+    balance and balance_snapshot, three statements however many keys there
+    are. Must run inside the same transaction as the transfer writes
+    """
+    cursor.execute(BALANCE_DELTA_TABLE_SQL)
+    cursor.execute("DELETE FROM balance_delta")
+    cursor.executemany("INSERT INTO balance_delta (person, sub_project, month, amount, income, spend) VALUES (?, ?, ?, ?, ?, ?)", [
+        (*key, *delta) for key, delta in deltas.items() if any(delta)])
+    cursor.execute(BALANCE_DELTA_UPSERT_SQL)
+    cursor.execute(SNAPSHOT_OPEN_SQL)
+    cursor.execute(SNAPSHOT_SHIFT_SQL)
+
+def transfer_delta(kind, amount, sign=1):
+    """(amount, income, spend) a transfer adds to its pair, sign is -1 when it is taken out"""
+    income = sign * amount if kind == '入账' else 0
+    spend = sign * amount if kind != '入账' else 0
+    return income - spend, income, spend
+
+def apply_balance_delta(person_id, sub_project_id, kind, amount, time, sign=1):
+    # must run inside the same transaction as the transfer write, sign is -1
+    # when the transfer is taken out
+    apply_balance_deltas({(person_id, sub_project_id, time[:7]): transfer_delta(kind, amount, sign)})
+
+SIGNED_AMOUNT = "CASE transfer.kind WHEN '入账' THEN transfer.amount ELSE -transfer.amount END"
+
+# the balance right after each transfer of one pair dated since or later,
+# worked back from the current balance so the rows before since are never
+# read. Returns the first one below zero
+RUNNING_BALANCE_CHECK_SQL = f"""
+    SELECT time, balance FROM (
+        SELECT transfer.time, transfer.id,
+            ? - SUM({SIGNED_AMOUNT}) OVER () + SUM({SIGNED_AMOUNT}) OVER (ORDER BY transfer.time, transfer.id) AS balance
+        FROM transfer
+        WHERE transfer.person = ? AND transfer.sub_project = ? AND transfer.time >= ?
+    )
+    WHERE balance < 0
+    ORDER BY time, id
+    LIMIT 1
+"""
+
+def post_check_balance(person_id, sub_project_id, since=None):
+    """
+    the balance may not go below zero, at the end nor, when since is given,
+    right after any transfer dated since or later. Earlier points are not
+    touched by a write dated since
+    """
+    balance = get_balance_by_id(person_id, sub_project_id)
+    print('post check balance', format_amount(balance))
+    time = None
+    if balance >= 0 and since is not None:
+        item = cursor.execute(RUNNING_BALANCE_CHECK_SQL, (balance, person_id, sub_project_id, since)).fetchone()
+        if item:
+            time, balance = item
     if balance < 0:
-        raise BalanceError(f'{person} 在 {project} {sub_project} 上的余额会变成 {balance}')
+        person, project, sub_project = cursor.execute("""
+            SELECT person.name, project.name, sub_project.name
+            FROM person, sub_project
+            LEFT JOIN project ON sub_project.parent = project.id
+            WHERE person.id = ? AND sub_project.id = ?
+        """, (person_id, sub_project_id)).fetchone()
+        if time:
+            raise BalanceError(f'{person} 在 {project} {sub_project} 上的余额会在 {time} 变成 {format_amount(balance)}')
+        raise BalanceError(f'{person} 在 {project} {sub_project} 上的余额会变成 {format_amount(balance)}')
+
+def check_balances(since):
+    """post_check_balance every pair of since, {(person_id, sub_project_id): earliest changed time}"""
+    for (person_id, sub_project_id), time in since.items():
+        post_check_balance(person_id, sub_project_id, time)
+
+def merge_since(since, person_id, sub_project_id, time):
+    key = (person_id, sub_project_id)
+    since[key] = min(since.get(key, time), time)
+
+# balance right after each transfer of a page: per pair of the page the
+# window runs from its oldest row on, the current balance anchors the end
+RUNNING_BALANCE_SQL = f"""
+    WITH pair AS (
+        SELECT person, sub_project, MIN(time) AS since
+        FROM transfer WHERE id IN (SELECT value FROM json_each(?))
+        GROUP BY person, sub_project
+    )
+    SELECT id, balance FROM (
+        SELECT transfer.id,
+            balance.amount - SUM({SIGNED_AMOUNT}) OVER timeline
+                + SUM({SIGNED_AMOUNT}) OVER (timeline ORDER BY transfer.time, transfer.id) AS balance
+        FROM pair
+        JOIN transfer ON transfer.person = pair.person AND transfer.sub_project = pair.sub_project AND transfer.time >= pair.since
+        JOIN balance ON balance.person = pair.person AND balance.sub_project = pair.sub_project
+        WINDOW timeline AS (PARTITION BY transfer.person, transfer.sub_project)
+    )
+    WHERE id IN (SELECT value FROM json_each(?))
+"""
+
+def transfer_running_balance(ids):
+    """{id: balance of its (person, sub_project) right after the transfer}"""
+    ids = json.dumps(list(ids))
+    return dict(read_cursor().execute(RUNNING_BALANCE_SQL, (ids, ids)).fetchall())
+
+BALANCE_AGGREGATE_SQL = """
+    SELECT person, sub_project,
+        SUM(CASE kind WHEN '入账' THEN amount ELSE -amount END),
+        SUM(CASE kind WHEN '入账' THEN amount ELSE 0 END),
+        SUM(CASE kind WHEN '入账' THEN 0 ELSE amount END)
+    FROM transfer
+    GROUP BY person, sub_project
+"""
+
+def compute_balance():
+    cursor.execute(BALANCE_AGGREGATE_SQL)
+    return {(person_id, sub_project_id): (amount, income, spend) for (person_id, sub_project_id, amount, income, spend) in cursor.fetchall()}
+
+# the totals of each pair per month it has transfers in, summed up month by
+# month
+BALANCE_SNAPSHOT_FILL_SQL = """
+    INSERT INTO balance_snapshot (person, sub_project, month, amount, income, spend)
+    SELECT person, sub_project, month,
+        SUM(amount) OVER months, SUM(income) OVER months, SUM(spend) OVER months
+    FROM (
+        SELECT person, sub_project, substr(time, 1, 7) AS month,
+            SUM(CASE kind WHEN '入账' THEN amount ELSE -amount END) AS amount,
+            SUM(CASE kind WHEN '入账' THEN amount ELSE 0 END) AS income,
+            SUM(CASE kind WHEN '入账' THEN 0 ELSE amount END) AS spend
+        FROM transfer
+        GROUP BY person, sub_project, month
+    )
+    WINDOW months AS (PARTITION BY person, sub_project ORDER BY month)
+"""
+
+def fill_balance_snapshot():
+    cursor.execute("DELETE FROM balance_snapshot")
+    cursor.execute(BALANCE_SNAPSHOT_FILL_SQL)
+
+def rebuild_balance():
+    try:
+        cursor.execute('BEGIN')
+        cursor.execute("DELETE FROM balance")
+        cursor.execute("INSERT INTO balance (person, sub_project, amount, income, spend)" + BALANCE_AGGREGATE_SQL)
+        fill_balance_snapshot()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    changes.publish("transfer")
+
+def rebuild_snapshots():
+    try:
+        cursor.execute('BEGIN')
+        fill_balance_snapshot()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def next_month(month):
+    year, month = map(int, month.split('-'))
+    return f'{year + month // 12:04d}-{month % 12 + 1:02d}'
+
+# per pair its last snapshot before a month plus its transfers in (month,
+# until]. 'YYYY-MM' sorts right before the first day of that month. The
+# snapshot lookup is one seek per pair of balance, CROSS JOIN keeps sqlite
+# from walking every snapshot row instead
+BALANCE_AS_OF_SQL = f"""
+    SELECT person, sub_project, SUM(amount), SUM(income), SUM(spend) FROM (
+        SELECT snapshot.person, snapshot.sub_project, snapshot.amount, snapshot.income, snapshot.spend
+        FROM balance
+        CROSS JOIN balance_snapshot AS snapshot ON snapshot.person = balance.person AND snapshot.sub_project = balance.sub_project
+            AND snapshot.month = (
+                SELECT MAX(month) FROM balance_snapshot
+                WHERE person = balance.person AND sub_project = balance.sub_project AND month < ?)
+        UNION ALL
+        SELECT person, sub_project,
+            {SIGNED_AMOUNT},
+            CASE kind WHEN '入账' THEN amount ELSE 0 END,
+            CASE kind WHEN '入账' THEN 0 ELSE amount END
+        FROM transfer WHERE time > ? AND time <= ?
+    )
+    GROUP BY person, sub_project
+"""
+
+def balance_as_of(date):
+    """
+    {(person_id, sub_project_id): (amount, income, spend)} counting the
+    transfers up to and including date: the last snapshot of each pair
+    before the month of date plus a range scan over the days after it
+    """
+    rows = read_cursor().execute(BALANCE_AS_OF_SQL, (date[:7], date[:7], date)).fetchall()
+    return {(person_id, sub_project_id): (amount, income, spend) for person_id, sub_project_id, amount, income, spend in rows}
+
+def verify_balance():
+    """return [(person_id, sub_project_id, expected, actual)] for every pair where balance disagrees with a full recompute from transfer"""
+    expected = compute_balance()
+    actual = {}
+    for (person_id, sub_project_id, amount, income, spend) in cursor.execute("SELECT person, sub_project, amount, income, spend FROM balance").fetchall():
+        actual[(person_id, sub_project_id)] = (amount, income, spend)
+    mismatch = []
+    for key in sorted(expected.keys() | actual.keys()):
+        e = expected.get(key, (0, 0, 0))
+        a = actual.get(key, (0, 0, 0))
+        if e != a:
+            mismatch.append((*key, '/'.join(map(format_amount, e)), '/'.join(map(format_amount, a))))
+    return mismatch
 
 def person_name_to_id(name):
-    item = cursor.execute("SELECT id FROM person WHERE name=?", (name,)).fetchone()
-    if item is None:
+    person_id = dimension_cache.get().person_ids.get(name)
+    if person_id is None:
         raise InvalidInputError(f'人员 {name} 不存在')
-    return item[0]
+    return person_id
 
 def project_name_to_id(parent_name, name):
-    item = cursor.execute("SELECT id FROM project WHERE name=?", (parent_name,)).fetchone()
-    if item is None:
+    dimensions = dimension_cache.get()
+    project_id = dimensions.project_ids.get(parent_name)
+    if project_id is None:
         raise InvalidInputError(f'项目 {parent_name} 不存在')
-    project_id = item[0]
 
-    item = cursor.execute("SELECT id FROM sub_project WHERE name=? AND parent=?", (name, project_id)).fetchone()
-    if item is None:
+    sub_project_id = dimensions.sub_project_ids.get((project_id, name))
+    if sub_project_id is None:
         raise InvalidInputError(f'子项目 {name} 不存在')
-    sub_project_id = item[0]
 
     return sub_project_id
 
+TRANSFER_BY_ID_SQL = "SELECT person, sub_project, kind, amount, time FROM transfer WHERE id = ?"
+
 def add_transfer(time, person, project, sub_project, kind, amount, memo):
     person_id = person_name_to_id(person)
     sub_project_id = project_name_to_id(project, sub_project)
+    amount = transfer_amount_to_cents(amount)
 
     try:
         cursor.execute('BEGIN')
         cursor.execute(
             "INSERT INTO transfer (time, person, sub_project, kind, amount, memo) VALUES (?, ?, ?, ?, ?, ?)",
             (time, person_id, sub_project_id, kind, amount, memo))
-        post_check_balance(person, project, sub_project)
+        apply_balance_delta(person_id, sub_project_id, kind, amount, time)
+        post_check_balance(person_id, sub_project_id, time)
         conn.commit()
     except Exception:
         conn.rollback()
         raise
+    changes.publish("transfer")
 
 def delete_transfer(id_):
-    person, project, sub_project = cursor.execute("""
-        SELECT person.name, project.name, sub_project.name
-        FROM transfer
-        LEFT JOIN person ON transfer.person = person.id
-        LEFT JOIN sub_project ON transfer.sub_project = sub_project.id
-        LEFT JOIN project ON sub_project.parent = project.id
-        WHERE transfer.id = ?
-    """, (id_,)).fetchall()[0]
+    person_id, sub_project_id, kind, amount, time = cursor.execute(TRANSFER_BY_ID_SQL, (id_,)).fetchall()[0]
 
     try:
         cursor.execute('BEGIN')
         cursor.execute("DELETE FROM transfer WHERE id=?", (id_,))
-        post_check_balance(person, project, sub_project)
+        apply_balance_delta(person_id, sub_project_id, kind, amount, time, -1)
+        post_check_balance(person_id, sub_project_id, time)
         conn.commit()
     except Exception:
         conn.rollback()
         raise
+    changes.publish("transfer")
 
 def update_transfer(id_, time, person, project, sub_project, kind, amount, memo):
     person_id = person_name_to_id(person)
     sub_project_id = project_name_to_id(project, sub_project)
+    amount = transfer_amount_to_cents(amount)
 
-    old_person, old_project, old_sub_project = cursor.execute("""
-        SELECT person.name, project.name, sub_project.name
-        FROM transfer
-        LEFT JOIN person ON transfer.person = person.id
-        LEFT JOIN sub_project ON transfer.sub_project = sub_project.id
-        LEFT JOIN project ON sub_project.parent = project.id
-        WHERE transfer.id = ?
-    """, (id_,)).fetchall()[0]
+    old_person_id, old_sub_project_id, old_kind, old_amount, old_time = cursor.execute(TRANSFER_BY_ID_SQL, (id_,)).fetchall()[0]
 
     try:
         cursor.execute('BEGIN')
@@ -301,47 +1174,647 @@ def update_transfer(id_, time, person, project, sub_project, kind, amount, memo)
             SET time = ?, person = ?, sub_project = ?, kind = ?, amount = ?, memo = ?
             WHERE id = ?
         """, (time, person_id, sub_project_id, kind, amount, memo, id_))
-        for p in [old_person, person]:
-            for j, k in [(old_project, old_sub_project), (project, sub_project)]:
-                post_check_balance(p, j, k)
+        apply_balance_delta(old_person_id, old_sub_project_id, old_kind, old_amount, old_time, -1)
+        apply_balance_delta(person_id, sub_project_id, kind, amount, time)
+        since = {}
+        merge_since(since, old_person_id, old_sub_project_id, old_time)
+        merge_since(since, person_id, sub_project_id, time)
+        check_balances(since)
 
         conn.commit()
     except Exception:
         conn.rollback()
         raise
+    changes.publish("transfer")
 
-def get_transfer():
-    stmt = """
-        SELECT transfer.id, transfer.time, person.name, project.name, sub_project.name, transfer.kind, transfer.amount, transfer.memo
-        FROM transfer
-        LEFT JOIN person ON transfer.person = person.id
-        LEFT JOIN sub_project ON transfer.sub_project = sub_project.id
-        LEFT JOIN project ON sub_project.parent = project.id
-        ORDER BY time DESC
+# the ids go in as one json array, so a batch of any size is one parameter
+TRANSFER_IDS = "transfer.id IN (SELECT value FROM json_each(?))"
+TRANSFERS_BY_IDS_SQL = "SELECT person, sub_project, kind, amount, time FROM transfer WHERE " + TRANSFER_IDS
+
+def rewrite_transfers(ids, sql, params, rewrite):
+    """
+    run sql, a DELETE or UPDATE of transfer, on the transfers ids in one
+    transaction. rewrite maps an old (person, sub_project, kind, amount,
+    time) to the new one, None when the row goes away. Balance deltas are
+    summed per pair and month and applied in one pass, each affected pair
+    is checked once, from its earliest changed date on.
+    Returns the number of rows changed
+    """
+    ids = json.dumps(list(ids))
+    deltas = defaultdict(lambda: (0, 0, 0))
+    since = {}
+    try:
+        cursor.execute('BEGIN')
+        rows = cursor.execute(TRANSFERS_BY_IDS_SQL, (ids,)).fetchall()
+        for old in rows:
+            for row, sign in ((old, -1), (rewrite(old), 1)):
+                if row:
+                    person_id, sub_project_id, kind, amount, time = row
+                    key = (person_id, sub_project_id, time[:7])
+                    deltas[key] = tuple(map(sum, zip(deltas[key], transfer_delta(kind, amount, sign))))
+                    merge_since(since, person_id, sub_project_id, time)
+        cursor.execute(f"{sql} WHERE {TRANSFER_IDS}", (*params, ids))
+        apply_balance_deltas(deltas)
+        check_balances(since)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    changes.publish("transfer")
+    return len(rows)
+
+def delete_transfers(ids):
+    return rewrite_transfers(ids, "DELETE FROM transfer", (), lambda row: None)
+
+def reassign_transfers(ids, person='', project='', sub_project='', kind=''):
+    """move the transfers to another person, sub_project or kind, blank keeps the old value"""
+    person_id = person_name_to_id(person) if person else None
+    sub_project_id = project_name_to_id(project, sub_project) if project or sub_project else None
+    if kind and kind not in ('入账', '出账'):
+        raise InvalidInputError(f'类型 {kind} 无效')
+    kind = kind or None
+
+    def rewrite(row):
+        old_person_id, old_sub_project_id, old_kind, amount, time = row
+        return person_id or old_person_id, sub_project_id or old_sub_project_id, kind or old_kind, amount, time
+
+    return rewrite_transfers(
+        ids, "UPDATE transfer SET person = COALESCE(?, person), sub_project = COALESCE(?, sub_project), kind = COALESCE(?, kind)",
+        (person_id, sub_project_id, kind), rewrite)
+
+def shift_transfers(ids, days):
+    """move the transfers days later, earlier when negative"""
+    def rewrite(row):
+        *rest, time = row
+        return *rest, (datetime.date.fromisoformat(time) + datetime.timedelta(days=days)).isoformat()
+
+    # date() gives the same yyyy-MM-dd as the python side
+    return rewrite_transfers(ids, "UPDATE transfer SET time = date(time, ?)", (f'{days:+d} days',), rewrite)
+
+IMPORT_COLUMNS = ["时间", "人员", "项目", "子项目", "类型", "金额", "备注"]
+
+@lru_cache(maxsize=4096)
+def normalize_date(value):
+    # dumps repeat the same few hundred dates, so the parse is cached
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.strftime('%Y-%m-%d')
+    try:
+        year, month, day = (int(x) for x in str(value).strip().split('-'))
+        return datetime.date(year, month, day).isoformat()
+    except ValueError:
+        raise InvalidInputError(f'时间 {value} 无效')
+
+def import_rows(rows):
     """
-    cursor.execute(stmt)
-    return cursor.fetchall()
+    rows are lists of cells, the first one being the header with the names
+    in IMPORT_COLUMNS. yields (time, person, project, sub_project, kind,
+    amount, memo) with row numbers as seen in the file
+    """
+    rows = iter(rows)
+    header = [str(x).strip() if x is not None else '' for x in next(rows, [])]
+    missing = [name for name in IMPORT_COLUMNS[:-1] if name not in header]
+    if missing:
+        raise InvalidInputError(f'缺少列: {",".join(missing)}')
+    index = [header.index(name) if name in header else None for name in IMPORT_COLUMNS]
+    for row_number, row in enumerate(rows, 2):
+        values = [row[i] if i is not None and i < len(row) else None for i in index]
+        if all(x is None or x == '' for x in values):
+            continue
+        yield row_number, values
+
+def read_transfer_xlsx(file_name):
+    # read_only streams the sheet instead of building every cell up front
+    # openpyxl is only paid for once a file is actually read or written
+    import openpyxl
+    wb = openpyxl.load_workbook(file_name, read_only=True, data_only=True)
+    try:
+        yield from import_rows(wb.active.iter_rows(values_only=True))
+    finally:
+        wb.close()
 
-def filter_transfer(person, project, sub_project, kind):
-    stmt = '''
-        SELECT transfer.id, transfer.time, person.name, project.name, sub_project.name, transfer.kind, transfer.amount, transfer.memo
-        FROM transfer
-        LEFT JOIN person ON transfer.person = person.id
-        LEFT JOIN sub_project ON transfer.sub_project = sub_project.id
-        LEFT JOIN project ON sub_project.parent = project.id
-        WHERE 1 = 1
-    '''
-    if person:
-        stmt += f' AND person.name LIKE "%{person}%"'
-    if project:
-        stmt += f' AND project.name LIKE "%{project}%"'
-    if sub_project:
-        stmt += f' AND sub_project.name LIKE "%{sub_project}%"'
-    if kind:
-        stmt += f' AND transfer.kind = "{kind}"'
-    stmt += ' ORDER BY time DESC'
-    cursor.execute(stmt)
-    return cursor.fetchall()
+def read_transfer_csv(file_name):
+    with open(file_name, newline='', encoding='utf-8-sig') as f:
+        yield from import_rows(csv.reader(f))
+
+def import_transfers(rows):
+    """
+    insert (row_number, [time, person, project, sub_project, kind, amount,
+    memo]) in one transaction. names are resolved through in-memory maps and
+    the balance check runs once per affected (person, sub_project) after the
+    batch instead of once per row. returns the number of rows inserted
+    """
+    dimensions = dimension_cache.get()
+    person_ids = dimensions.person_ids
+    sub_project_ids = {(project, sub_project): id_ for id_, project, sub_project in dimensions.ordered_sub_projects()}
+
+    transfers = []
+    deltas = defaultdict(lambda: (0, 0, 0))
+    since = {}
+    for row_number, (time_, person, project, sub_project, kind, amount, memo) in rows:
+        try:
+            time_ = normalize_date(time_)
+            person = str(person or '').strip()
+            if person not in person_ids:
+                raise InvalidInputError(f'人员 {person} 不存在')
+            key = (str(project or '').strip(), str(sub_project or '').strip())
+            if key not in sub_project_ids:
+                raise InvalidInputError(f'项目 {key[0]} 子项目 {key[1]} 不存在')
+            kind = str(kind or '').strip()
+            if kind not in ('入账', '出账'):
+                raise InvalidInputError(f'类型 {kind} 无效')
+            amount = transfer_amount_to_cents(amount)
+        except InvalidInputError as e:
+            raise InvalidInputError(f'第 {row_number} 行: {e}')
+        person_id = person_ids[person]
+        sub_project_id = sub_project_ids[key]
+        transfers.append((time_, person_id, sub_project_id, kind, amount, '' if memo is None else str(memo)))
+        key = (person_id, sub_project_id, time_[:7])
+        deltas[key] = tuple(map(sum, zip(deltas[key], transfer_delta(kind, amount))))
+        merge_since(since, person_id, sub_project_id, time_)
+
+    try:
+        cursor.execute('BEGIN')
+        # index the new rows in one statement instead of firing the fts
+        # trigger per row, the trigger comes back in the same transaction
+        last_id = cursor.execute("SELECT MAX(id) FROM transfer").fetchone()[0] or 0
+        cursor.execute("DROP TRIGGER IF EXISTS transfer_fts_insert")
+        cursor.executemany(
+            "INSERT INTO transfer (time, person, sub_project, kind, amount, memo) VALUES (?, ?, ?, ?, ?, ?)",
+            transfers)
+        cursor.execute(TRANSFER_FTS_FILL_SQL, (last_id,))
+        cursor.execute(TRANSFER_FTS_INSERT_TRIGGER)
+        apply_balance_deltas(deltas)
+        check_balances(since)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    changes.publish("transfer")
+    return len(transfers)
+
+def import_transfer_file(file_name):
+    if file_name.lower().endswith('.csv'):
+        return import_transfers(read_transfer_csv(file_name))
+    return import_transfers(read_transfer_xlsx(file_name))
+
+def generate_ledger(transfers, persons=10, projects=5, sub_projects=4, seed=0, start='2020-01-01', days=1826):
+    """
+    replace everything in the open database with a synthetic ledger for
+    benchmarks: sub_projects per project, transfers spread over days from
+    start. The same seed gives the same ledger, and an 出账 never overdraws
+    its balance at the time it is made
+    """
+    rnd = random.Random(seed)
+    first = datetime.date.fromisoformat(start)
+    try:
+        cursor.execute("BEGIN")
+        for table in ("transfer", "balance", "balance_snapshot", "sub_project", "project", "person"):
+            cursor.execute(f"DELETE FROM {table}")
+        cursor.executemany("INSERT INTO person (name) VALUES (?)", [(f'人员{i}',) for i in range(1, persons + 1)])
+        cursor.executemany("INSERT INTO project (name, rank) VALUES (?, ?)",
+                           [(f'项目{i}', i * RANK_GAP) for i in range(1, projects + 1)])
+        cursor.executemany("INSERT INTO sub_project (name, parent, rank) SELECT ?, id, ? FROM project",
+                           [(f'子项目{i}', i * RANK_GAP) for i in range(1, sub_projects + 1)])
+        person_ids = [id_ for (id_,) in cursor.execute("SELECT id FROM person").fetchall()]
+        sub_project_ids = [id_ for (id_,) in cursor.execute("SELECT id FROM sub_project").fetchall()]
+
+        def rows():
+            # rows go in by date, so ids follow time and the balance seen by
+            # each 出账 is the one at its point in the timeline
+            balance = defaultdict(int)
+            for offset in sorted(rnd.randrange(days) for _ in range(transfers)):
+                key = (rnd.choice(person_ids), rnd.choice(sub_project_ids))
+                amount = rnd.randint(100, 1000000)
+                if rnd.random() < 0.4 and balance[key] >= amount:
+                    kind = '出账'
+                    balance[key] -= amount
+                else:
+                    kind = '入账'
+                    balance[key] += amount
+                yield ((first + datetime.timedelta(days=offset)).isoformat(), *key, kind, amount, f'备注{rnd.randrange(1000)}')
+
+        cursor.executemany(
+            "INSERT INTO transfer (time, person, sub_project, kind, amount, memo) VALUES (?, ?, ?, ?, ?, ?)", rows())
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    changes.publish(*TABLES)
+    rebuild_balance()
+
+TRANSFER_SELECT = """
+    SELECT transfer.id, transfer.time, person.name, project.name, sub_project.name, transfer.kind, transfer.amount, transfer.memo
+    FROM transfer
+    LEFT JOIN person ON transfer.person = person.id
+    LEFT JOIN sub_project ON transfer.sub_project = sub_project.id
+    LEFT JOIN project ON sub_project.parent = project.id
+"""
+
+class TransferFilter:
+    """conditions of the transfer list, empty string means no condition"""
+
+    def __init__(self, person="", project="", sub_project="", kind="", date_from="", date_to="", amount_min="", amount_max="", text=""):
+        self.person = person
+        self.project = project
+        self.sub_project = sub_project
+        self.kind = kind
+        self.date_from = date_from
+        self.date_to = date_to
+        self.amount_min = amount_min
+        self.amount_max = amount_max
+        self.text = text
+
+    def is_empty(self):
+        return not self.describe()
+
+    def describe(self):
+        items = [x for x in (self.text, self.person, self.project, self.sub_project, self.kind) if x]
+        if self.date_from:
+            items.append(f'>={self.date_from}')
+        if self.date_to:
+            items.append(f'<={self.date_to}')
+        if self.amount_min:
+            items.append(f'金额>={self.amount_min}')
+        if self.amount_max:
+            items.append(f'金额<={self.amount_max}')
+        return items
+
+# every condition only touches transfer columns, names are resolved through
+# the small dimension tables so the transfer indexes stay usable
+TRANSFER_FILTER_CLAUSES = {
+    'person_id': "transfer.person = ?",
+    'person_like': "transfer.person IN (SELECT id FROM person WHERE name LIKE ? ESCAPE '\\')",
+    'project_id': "transfer.sub_project IN (SELECT id FROM sub_project WHERE parent = ?)",
+    'project_like': """transfer.sub_project IN (
+        SELECT sub_project.id FROM sub_project JOIN project ON sub_project.parent = project.id
+        WHERE project.name LIKE ? ESCAPE '\\')""",
+    'sub_project_name': "transfer.sub_project IN (SELECT id FROM sub_project WHERE name = ?)",
+    'sub_project_like': "transfer.sub_project IN (SELECT id FROM sub_project WHERE name LIKE ? ESCAPE '\\')",
+    'kind': "transfer.kind = ?",
+    'text_match': "transfer.id IN (SELECT rowid FROM transfer_fts WHERE transfer_fts MATCH ?)",
+    # trigram can't look up terms shorter than 3 characters
+    'text_like': """(transfer.memo LIKE ? ESCAPE '\\'
+        OR transfer.person IN (SELECT id FROM person WHERE name LIKE ? ESCAPE '\\')
+        OR transfer.sub_project IN (
+            SELECT sub_project.id FROM sub_project JOIN project ON sub_project.parent = project.id
+            WHERE sub_project.name LIKE ? ESCAPE '\\' OR project.name LIKE ? ESCAPE '\\'))""",
+    'date_from': "transfer.time >= ?",
+    'date_to': "transfer.time <= ?",
+    'amount_min': "transfer.amount >= ?",
+    'amount_max': "transfer.amount <= ?",
+    'after': "(transfer.time, transfer.id) < (?, ?)",
+}
+
+def like_pattern(text):
+    escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'%{escaped}%'
+
+def resolve_transfer_filter(transfer_filter):
+    """return (shape, params), shape names the TRANSFER_FILTER_CLAUSES to AND together"""
+    shape = []
+    params = []
+    match_terms = []
+    for term in transfer_filter.text.split():
+        if len(term) >= 3:
+            # quoted as a phrase so fts5 query syntax in the input is literal
+            match_terms.append('"' + term.replace('"', '""') + '"')
+        else:
+            shape.append('text_like')
+            params.extend([like_pattern(term)] * 4)
+    if match_terms:
+        shape.append('text_match')
+        params.append(' '.join(match_terms))
+    dimensions = dimension_cache.get()
+    if transfer_filter.person:
+        person_id = dimensions.person_ids.get(transfer_filter.person)
+        if person_id is not None:
+            shape.append('person_id')
+            params.append(person_id)
+        else:
+            shape.append('person_like')
+            params.append(like_pattern(transfer_filter.person))
+    if transfer_filter.project:
+        project_id = dimensions.project_ids.get(transfer_filter.project)
+        if project_id is not None:
+            shape.append('project_id')
+            params.append(project_id)
+        else:
+            shape.append('project_like')
+            params.append(like_pattern(transfer_filter.project))
+    if transfer_filter.sub_project:
+        if transfer_filter.sub_project in dimensions.sub_project_names.values():
+            shape.append('sub_project_name')
+            params.append(transfer_filter.sub_project)
+        else:
+            shape.append('sub_project_like')
+            params.append(like_pattern(transfer_filter.sub_project))
+    if transfer_filter.kind:
+        shape.append('kind')
+        params.append(transfer_filter.kind)
+    if transfer_filter.date_from:
+        shape.append('date_from')
+        params.append(transfer_filter.date_from)
+    if transfer_filter.date_to:
+        shape.append('date_to')
+        params.append(transfer_filter.date_to)
+    if transfer_filter.amount_min:
+        shape.append('amount_min')
+        params.append(amount_to_cents(transfer_filter.amount_min))
+    if transfer_filter.amount_max:
+        shape.append('amount_max')
+        params.append(amount_to_cents(transfer_filter.amount_max))
+    return tuple(shape), params
+
+@lru_cache(maxsize=None)
+def transfer_filter_where(shape):
+    # the statement text only depends on the shape, so sqlite3's statement
+    # cache can reuse the prepared statement across different filter values
+    if not shape:
+        return ""
+    return " WHERE " + " AND ".join(TRANSFER_FILTER_CLAUSES[name] for name in shape)
+
+TRANSFER_PAGE_SIZE = 500
+
+def transfer_page(shape, params, after, limit):
+    if after:
+        shape = shape + ('after',)
+        params = [*params, *after]
+    stmt = TRANSFER_SELECT + transfer_filter_where(shape) + " ORDER BY transfer.time DESC, transfer.id DESC LIMIT ?"
+    return read_cursor().execute(stmt, (*params, limit)).fetchall()
+
+def filter_transfer(transfer_filter, after=None, limit=TRANSFER_PAGE_SIZE):
+    """return one page of matching transfers, newest first. after is the (time, id) of the last row of the previous page"""
+    shape, params = resolve_transfer_filter(transfer_filter)
+    return transfer_page(shape, params, after, limit)
+
+def iter_transfer(transfer_filter=None, page_size=TRANSFER_PAGE_SIZE):
+    """yield the matching transfers, newest first, in lists of at most page_size rows"""
+    shape, params = resolve_transfer_filter(transfer_filter or TransferFilter())
+    after = None
+    while True:
+        rows = transfer_page(shape, params, after, page_size)
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            return
+        after = transfer_key(rows[-1])
+
+def transfer_first_page(transfer_filter, limit=TRANSFER_PAGE_SIZE):
+    return count_transfer(transfer_filter), filter_transfer(transfer_filter, None, limit)
+
+def transfer_key(row):
+    id_, time = row[0], row[1]
+    return time, id_
+
+def count_transfer(transfer_filter):
+    shape, params = resolve_transfer_filter(transfer_filter)
+    return read_cursor().execute("SELECT COUNT(*) FROM transfer" + transfer_filter_where(shape), params).fetchone()[0]
+
+class SummaryPivot:
+    """person x sub_project totals in cents, keyed by id"""
+
+    def __init__(self, persons, columns, cells):
+        self.persons = persons  # [(person_id, name)]
+        self.columns = columns  # [(sub_project_id, project name, sub_project name)]
+        self.cells = cells      # {(person_id, sub_project_id): (income, spend)}
+        self.person_totals = defaultdict(lambda: (0, 0))
+        self.column_totals = defaultdict(int)
+        for (person_id, sub_project_id), (income, spend) in cells.items():
+            person_income, person_spend = self.person_totals[person_id]
+            self.person_totals[person_id] = (person_income + income, person_spend + spend)
+            self.column_totals[sub_project_id] += income - spend
+
+    def cell(self, person_id, sub_project_id):
+        return self.cells.get((person_id, sub_project_id), (0, 0))
+
+    def total(self):
+        return sum(self.column_totals.values())
+
+def get_summary_pivot(as_of=None):
+    # the per-pair totals are kept in balance, so this is O(cells) rather
+    # than O(transfers). A past date costs one snapshot seek per pair plus
+    # less than a month of transfers
+    dimensions = dimension_cache.get()
+    persons = dimensions.persons
+    columns = list(dimensions.ordered_sub_projects())
+    cells = {}
+    if as_of:
+        for (person_id, sub_project_id), (_, income, spend) in balance_as_of(as_of).items():
+            cells[(person_id, sub_project_id)] = (income, spend)
+    else:
+        for person_id, sub_project_id, income, spend in read_cursor().execute("SELECT person, sub_project, income, spend FROM balance").fetchall():
+            cells[(person_id, sub_project_id)] = (income, spend)
+    return SummaryPivot(persons, columns, cells)
+
+# bucket label of a transfer time in SQL, and of a 'YYYY-MM' month in python
+PERIOD_BUCKETS = {
+    'month': ("substr(time, 1, 7)", lambda month: month),
+    'quarter': ("substr(time, 1, 4) || '-Q' || ((CAST(substr(time, 6, 2) AS INTEGER) + 2) / 3)",
+                lambda month: f'{month[:4]}-Q{(int(month[5:]) + 2) // 3}'),
+    'year': ("substr(time, 1, 4)", lambda month: month[:4]),
+}
+
+PERIOD_GROUPS = ('person', 'sub_project')
+
+# a range scan over transfer_list_idx grouped per row and bucket, the
+# placeholders are filled from PERIOD_GROUPS and PERIOD_BUCKETS only
+PERIOD_SUMMARY_SQL = """
+    SELECT {group}, {bucket} AS period,
+        SUM(CASE kind WHEN '入账' THEN amount ELSE 0 END),
+        SUM(CASE kind WHEN '入账' THEN 0 ELSE amount END)
+    FROM transfer
+    WHERE time >= ? AND time <= ?
+    GROUP BY {group}, period
+"""
+
+class PeriodSummary:
+    """income and spend in cents per (row, period), rows are persons or sub_projects"""
+
+    def __init__(self, rows, periods, cells, opening):
+        self.rows = rows        # [(id, label)]
+        self.periods = periods  # bucket labels in order
+        self.cells = cells      # {(id, period): (income, spend)}
+        self.opening = opening  # {id: balance before the first period}
+
+    def net(self, row_id, period):
+        income, spend = self.cells.get((row_id, period), (0, 0))
+        return income - spend
+
+    def period_total(self, period):
+        return sum(self.net(row_id, period) for row_id, _ in self.rows)
+
+    def headers(self, running):
+        return self.periods + ([] if running else ['合计'])
+
+    def table(self, running):
+        """
+        [(label, [cents])] with one value per header and a last 合计 row.
+        running gives the balance at the end of each period instead of the
+        change within it
+        """
+        table = []
+        for row_id, label in self.rows:
+            values = [self.net(row_id, period) for period in self.periods]
+            if running:
+                values = list(accumulate(values, initial=self.opening.get(row_id, 0)))[1:]
+            else:
+                values.append(sum(values))
+            table.append((label, values))
+        totals = [self.period_total(period) for period in self.periods]
+        if running:
+            totals = list(accumulate(totals, initial=sum(self.opening.values())))[1:]
+        else:
+            totals.append(sum(totals))
+        table.append(('合计', totals))
+        return table
+
+def get_period_summary(period, group, date_from='', date_to=''):
+    """bucket transfers in [date_from, date_to] (blank is open) per person or sub_project by month, quarter or year"""
+    bucket, month_label = PERIOD_BUCKETS[period]
+    if group not in PERIOD_GROUPS:
+        raise ValueError(group)
+    dimensions = dimension_cache.get()
+    if group == 'person':
+        rows = dimensions.persons
+    else:
+        rows = [(id_, f'{project}/{sub_project}') for id_, project, sub_project in dimensions.ordered_sub_projects()]
+
+    cur = read_cursor()
+    date_to = date_to or '9999-12-31'
+    cells = {}
+    for row_id, label, income, spend in cur.execute(PERIOD_SUMMARY_SQL.format(group=group, bucket=bucket), (date_from, date_to)).fetchall():
+        cells[(row_id, label)] = (income, spend)
+
+    # the running balance starts from the balance the day before the range
+    opening = defaultdict(int)
+    if date_from:
+        before = (datetime.date.fromisoformat(date_from) - datetime.timedelta(days=1)).isoformat()
+        for (person_id, sub_project_id), (amount, _, _) in balance_as_of(before).items():
+            opening[person_id if group == 'person' else sub_project_id] += amount
+
+    # every bucket of the range is listed, empty ones included
+    first, last = cur.execute("SELECT MIN(time), MAX(time) FROM transfer WHERE time >= ? AND time <= ?", (date_from, date_to)).fetchone()
+    start = date_from or first
+    end = last if date_to == '9999-12-31' else date_to
+    periods = []
+    if start and end:
+        month = start[:7]
+        while month <= end[:7]:
+            label = month_label(month)
+            if not periods or periods[-1] != label:
+                periods.append(label)
+            month = next_month(month)
+    return PeriodSummary(rows, periods, cells, opening)
+
+# statements whose plan must not fall back to a full scan, checked by
+# check_query_plan at startup. The ON DELETE RESTRICT lookups sqlite runs
+# internally are listed as their equivalent SELECT. The transfer list and
+# count queries come from transfer_filter_shapes.
+QUERY_PLAN_AUDIT = [
+    ('get_balance', GET_BALANCE_SQL),
+    ('get_balance_by_id', BALANCE_BY_ID_SQL),
+    ('transfer by id', TRANSFER_BY_ID_SQL),
+    ('post_check_balance', RUNNING_BALANCE_CHECK_SQL),
+    ('transfer_running_balance', RUNNING_BALANCE_SQL),
+    ('rewrite_transfers', TRANSFERS_BY_IDS_SQL),
+    ('balance_as_of', BALANCE_AS_OF_SQL),
+    ('get_period_summary', PERIOD_SUMMARY_SQL.format(group='person', bucket=PERIOD_BUCKETS['quarter'][0])),
+    ('add_project', "SELECT MAX(rank) FROM project"),
+    ('move_ranked', "SELECT rank FROM project WHERE 1 AND rank < ? AND name NOT IN (?) ORDER BY rank DESC LIMIT 1"),
+    ('move_ranked', "SELECT rank FROM sub_project WHERE parent = ? AND rank < ? AND name NOT IN (?) ORDER BY rank DESC LIMIT 1"),
+    ('delete_person', "SELECT 1 FROM transfer WHERE person=?"),
+    ('delete_sub_project', "SELECT 1 FROM transfer WHERE sub_project=?"),
+    ('delete_project', "SELECT 1 FROM sub_project WHERE parent=?"),
+]
+
+# scans accepted in one QUERY_PLAN_AUDIT entry
+QUERY_PLAN_ALLOWED_SCANS = {
+    # one snapshot seek per pair, every pair is in the result anyway
+    'balance_as_of': ('SCAN balance',),
+}
+
+# the clause lists resolve_transfer_filter can pick for each input, in the
+# order it appends them
+TRANSFER_FILTER_CHOICES = [
+    ((), ('text_like',), ('text_match',), ('text_like', 'text_match')),
+    ((), ('person_id',), ('person_like',)),
+    ((), ('project_id',), ('project_like',)),
+    ((), ('sub_project_name',), ('sub_project_like',)),
+    ((), ('kind',)),
+    ((), ('date_from',)),
+    ((), ('date_to',)),
+    ((), ('amount_min',)),
+    ((), ('amount_max',)),
+]
+
+# scans check_query_plan accepts. The dimension tables are small and a LIKE
+# on their names has to read them
+ALLOWED_SCANS = ('SCAN person', 'SCAN project', 'SCAN sub_project')
+
+# (applies to shape, scans accepted) for the transfer queries of a shape
+TRANSFER_ALLOWED_SCANS = [
+    # the count reads every row, a page walks transfer_list_idx in list
+    # order and stops once it is full
+    (lambda shape: not shape, ('SCAN transfer',)),
+    # terms shorter than a trigram can't be looked up in transfer_fts
+    (lambda shape: 'text_like' in shape, ('SCAN transfer',)),
+    # with a single amount bound sqlite judges the range too wide for
+    # transfer_amount_idx and a page walks transfer_list_idx in list order
+    # until it is full, linear in the rows skipped. With both bounds the page
+    # searches transfer_amount_idx and sorts the matches, no scan
+    (lambda shape: ('amount_min' in shape) != ('amount_max' in shape),
+     ('SCAN transfer USING COVERING INDEX transfer_list_idx',)),
+]
+
+def transfer_filter_shapes(every=False):
+    """the shape without conditions and each clause alone, or with every, each shape resolve_transfer_filter can produce"""
+    if every:
+        for choice in product(*TRANSFER_FILTER_CHOICES):
+            yield tuple(chain.from_iterable(choice))
+        return
+    yield ()
+    for name in TRANSFER_FILTER_CLAUSES:
+        if name != 'after':
+            yield (name,)
+
+def transfer_filter_audit(every=False):
+    """(name, sql, allowed scans) of the count, first page and next page queries of every shape"""
+    for shape in transfer_filter_shapes(every):
+        allowed = tuple(chain.from_iterable(scans for applies, scans in TRANSFER_ALLOWED_SCANS if applies(shape)))
+        label = '+'.join(shape)
+        yield f'count_transfer {label}', "SELECT COUNT(*) FROM transfer" + transfer_filter_where(shape), allowed
+        for page_shape in (shape, shape + ('after',)):
+            yield (f"filter_transfer {'+'.join(page_shape)}",
+                   TRANSFER_SELECT + transfer_filter_where(page_shape) + " ORDER BY transfer.time DESC, transfer.id DESC LIMIT ?",
+                   allowed)
+
+def scan_allowed(detail, allowed, tables):
+    if not detail.startswith('SCAN '):
+        # SEARCH is an index lookup, the rest are not row sources
+        return True
+    if detail.split()[1] not in tables:
+        # SCAN (subquery-N), a WITH name or a table-valued function walks a query result
+        return True
+    if 'VIRTUAL TABLE INDEX' in detail and not detail.endswith(':'):
+        # the virtual table got constraints it uses, e.g. an fts MATCH
+        return True
+    return any(detail == scan or detail.startswith(scan + ' ') for scan in ALLOWED_SCANS + allowed)
+
+def check_query_plan(every=False):
+    """
+    return [(name, detail)] for every full scan of a table or index in the
+    plans of QUERY_PLAN_AUDIT and the transfer filter queries, see
+    transfer_filter_shapes for every
+    """
+    scans = []
+    tables = {name for (name,) in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()}
+    audit = [(name, sql, QUERY_PLAN_ALLOWED_SCANS.get(name, ())) for name, sql in QUERY_PLAN_AUDIT] + list(transfer_filter_audit(every))
+    for name, sql, allowed in audit:
+        params = (None,) * sql.count('?')
+        for (_, _, _, detail) in cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall():
+            if not scan_allowed(detail, allowed, tables):
+                scans.append((name, detail))
+    return scans
 
 class LazyComboBox(QComboBox):
     def __init__(self, get_items, parent=None):
@@ -375,6 +1848,20 @@ def create_kind_combo(need_blank=False):
     combo.addItems(["入账", "出账"])
     return combo
 
+def create_optional_date_edit():
+    # the minimum date is shown blank and stands for no date
+    edit = QDateEdit()
+    edit.setCalendarPopup(True)
+    edit.setMinimumDate(QDate(2000, 1, 1))
+    edit.setSpecialValueText(" ")
+    edit.setDate(edit.minimumDate())
+    return edit
+
+def optional_date_text(edit):
+    if edit.date() == edit.minimumDate():
+        return ""
+    return edit.date().toString("yyyy-MM-dd")
+
 def question_box(title, text):
     msg_box = QMessageBox()
     msg_box.setIcon(QMessageBox.Question)
@@ -392,29 +1879,279 @@ def question_box(title, text):
     # Determine which button was clicked
     return msg_box.clickedButton() == yes_button
 
-def excel_from_table(table: QTableWidget, title, export_vertical_header):
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = title
+def excel_from_transfers(transfer_filter, title, progress=None):
+    import openpyxl
+    from openpyxl.cell import WriteOnlyCell
+
+    # write_only keeps only the current row in memory, rows are streamed page
+    # by page from the database and amounts stay numeric
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet(title)
+
+    ws.append(["时间", "人员", "项目", "子项目", "类型", "金额", "备注"])
+    done = 0
+    for rows in iter_transfer(transfer_filter):
+        for id_, time, person, project, sub_project, kind, amount, memo in rows:
+            amount_cell = WriteOnlyCell(ws, value=cents_to_amount(amount))
+            amount_cell.number_format = '0.00'
+            ws.append([time, person, project, sub_project, kind, amount_cell, memo])
+        done += len(rows)
+        if progress:
+            progress(done)
+
+    return wb
 
-    # Get the headers from the table and add them to the first row in the sheet
-    for col in range(table.columnCount()):
-        ws.cell(row=1, column=col+2, value=table.horizontalHeaderItem(col).text())
+def excel_from_summary(pivot: SummaryPivot, progress=None):
+    import openpyxl
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Alignment
+    from openpyxl.worksheet.cell_range import CellRange
+
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("流水统计")
+    center = Alignment(horizontal='center', vertical='center')
+
+    def cell(value):
+        c = WriteOnlyCell(ws, value=value)
+        c.alignment = center
+        return c
+
+    def amount(cents):
+        c = cell(cents_to_amount(cents))
+        c.number_format = '0.00'
+        return c
+
+    def merge(start_row, start_column, end_row, end_column):
+        ws.merged_cells.add(CellRange(min_row=start_row, min_col=start_column, max_row=end_row, max_col=end_column))
+
+    # layout: two header rows (project, sub_project) and two header columns
+    # (person, 入/出), then one column per sub_project followed by
+    # 人员统计 and 人员合计, and a last 项目合计 row. A write_only sheet is
+    # filled strictly row by row, merged ranges are only recorded
+    first_col = 3
+    person_col = first_col + len(pivot.columns)
+    total_row = 3 + 2 * len(pivot.persons)
+
+    merge(1, 1, 2, 2)
+
+    project_row = [None, None]
+    sub_project_row = [None, None]
+    project_start_col = first_col
+    for i, (_, project, sub_project) in enumerate(pivot.columns):
+        col = first_col + i
+        sub_project_row.append(sub_project)
+        project_row.append(None)
+        # merge adjacent columns of the same project
+        if i + 1 == len(pivot.columns) or pivot.columns[i + 1][1] != project:
+            project_row[project_start_col - 1] = cell(project)
+            if col > project_start_col:
+                merge(1, project_start_col, 1, col)
+            project_start_col = col + 1
+
+    project_row += [cell('人员统计'), cell('人员合计')]
+    for col in (person_col, person_col + 1):
+        merge(1, col, 2, col)
+    ws.append(project_row)
+    ws.append(sub_project_row)
+
+    for x, (person_id, person) in enumerate(pivot.persons):
+        row = 3 + x * 2
+        merge(row, 1, row + 1, 1)
+        merge(row, person_col + 1, row + 1, person_col + 1)
+        income_row = [cell(person), '入']
+        spend_row = [None, '出']
+
+        for sub_project_id, _, _ in pivot.columns:
+            income, spend = pivot.cell(person_id, sub_project_id)
+            income_row.append(amount(income))
+            spend_row.append(amount(spend))
+
+        income, spend = pivot.person_totals[person_id]
+        income_row += [amount(income), amount(income - spend)]
+        spend_row.append(amount(spend))
+        ws.append(income_row)
+        ws.append(spend_row)
+        if progress:
+            progress(x + 1)
+
+    merge(total_row, 1, total_row, 2)
+    merge(total_row, person_col, total_row, person_col + 1)
+    ws.append([cell('项目合计'), None]
+              + [amount(pivot.column_totals[sub_project_id]) for sub_project_id, _, _ in pivot.columns]
+              + [amount(pivot.total())])
 
-    # Get the vertical headers (row headers) and add them to the first column
-    if export_vertical_header:
-        for row in range(table.rowCount()):
-            ws.cell(row=row+2, column=1, value=table.verticalHeaderItem(row).text())
+    return wb
 
-    # Get the table data and add it to the sheet starting from row 2
-    for row in range(table.rowCount()):
-        for col in range(table.columnCount()):
-            item = table.item(row, col)
-            if item:
-                ws.cell(row=row+2, column=col+2, value=item.text())
+def excel_from_period_summary(summary: PeriodSummary, running, progress=None):
+    import openpyxl
+    from openpyxl.cell import WriteOnlyCell
+
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("分期统计")
+
+    ws.append([''] + summary.headers(running))
+    for x, (label, values) in enumerate(summary.table(running)):
+        row = [label]
+        for value in values:
+            cell = WriteOnlyCell(ws, value=cents_to_amount(value))
+            cell.number_format = '0.00'
+            row.append(cell)
+        ws.append(row)
+        if progress:
+            progress(x + 1)
 
     return wb
 
+class ExportSignals(QObject):
+    progress = Signal(int)
+    finished = Signal(str)
+
+class ExportTask(QRunnable):
+    """
+    builds and saves a workbook on a QThreadPool thread, reads go through
+    read_cursor on a reader borrowed for the run
+    """
+
+    def __init__(self, file_name, build):
+        super().__init__()
+        self.file_name = file_name
+        self.build = build
+        self.signals = ExportSignals()
+
+    @override
+    def run(self):
+        try:
+            with db.borrow():
+                wb = self.build(self.signals.progress.emit)
+            wb.save(self.file_name)
+            msg_content = "导出成功，文件已保存到 {}".format(self.file_name)
+        except Exception as e:
+            traceback.print_exc()
+            msg_content = "导出失败，错误信息：{}".format(str(e))
+        self.signals.finished.emit(msg_content)
+
+class QuerySignals(QObject):
+    done = Signal(object)
+    failed = Signal(object)
+    finished = Signal()
+
+class QueryTask(QRunnable):
+    def __init__(self, fn):
+        super().__init__()
+        self.fn = fn
+        self.cancelled = False
+        self.connection = None
+        self.lock = threading.Lock()
+        self.signals = QuerySignals()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            if self.connection is not None:
+                # abort the statement running on the worker, the lock makes
+                # sure the connection is not already serving another task
+                self.connection.interrupt()
+
+    @override
+    def run(self):
+        try:
+            if self.cancelled:
+                return
+            with db.borrow() as connection:
+                with self.lock:
+                    if self.cancelled:
+                        return
+                    self.connection = connection
+                try:
+                    result = self.fn()
+                except Exception as e:
+                    if not self.cancelled:
+                        self.signals.failed.emit(e)
+                else:
+                    if not self.cancelled:
+                        self.signals.done.emit(result)
+                finally:
+                    # the reader goes back to the pool after this, a late
+                    # cancel must not interrupt its next task
+                    with self.lock:
+                        self.connection = None
+        finally:
+            self.signals.finished.emit()
+
+class QueryExecutor:
+    """
+    runs read queries on QThreadPool threads and hands the result back on
+    the GUI thread. Submitting under a key cancels the request still pending
+    under it, so only the latest filter of a view ever renders
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.tasks = set()
+
+    def submit(self, key, fn, on_result, on_error=None):
+        previous = self.pending.pop(key, None)
+        if previous:
+            previous.cancel()
+        task = QueryTask(fn)
+        self.pending[key] = task
+        # the task must outlive the pool thread running it
+        self.tasks.add(task)
+
+        def done(result):
+            if task.cancelled:
+                return
+            del self.pending[key]
+            on_result(result)
+
+        def failed(e):
+            if task.cancelled:
+                return
+            del self.pending[key]
+            if on_error:
+                on_error(e)
+            else:
+                traceback.print_exception(e)
+
+        task.signals.done.connect(done)
+        task.signals.failed.connect(failed)
+        task.signals.finished.connect(lambda: self.tasks.discard(task))
+        QThreadPool.globalInstance().start(task)
+        return task
+
+    def cancel(self, key):
+        task = self.pending.pop(key, None)
+        if task:
+            task.cancel()
+
+    def busy(self):
+        return bool(self.pending)
+
+query_executor = QueryExecutor()
+
+def start_export(parent, file_name, total, build):
+    progress = QProgressDialog("正在导出...", None, 0, total, parent)
+    progress.setWindowTitle("导出")
+    progress.setWindowModality(Qt.WindowModal)
+    progress.setMinimumDuration(0)
+
+    def finished(msg_content):
+        progress.close()
+        parent.export_task = None
+        msg = QMessageBox()
+        msg.setIcon(QMessageBox.Information)
+        msg.setText(msg_content)
+        msg.setWindowTitle("导出结果")
+        msg.setStandardButtons(QMessageBox.Ok)
+        msg.exec()
+
+    task = ExportTask(file_name, build)
+    task.signals.progress.connect(progress.setValue)
+    task.signals.finished.connect(finished)
+    # keep the signals object alive until the task reports back
+    parent.export_task = task
+    QThreadPool.globalInstance().start(task)
+
 class EditTranferDialog(QDialog):
     def __init__(self, id_, time, person, project, sub_project, kind, amount, memo):
         super().__init__()
@@ -496,6 +2233,61 @@ class EditTranferDialog(QDialog):
             return
         self.accept()
 
+class BatchEditDialog(QDialog):
+    """reassign the selected transfers, a blank field keeps each row's own value"""
+
+    def __init__(self, ids):
+        super().__init__()
+
+        self.ids = ids
+        self.count = 0
+
+        self.setWindowTitle(f"批量修改 {len(ids)} 条")
+
+        self.person_combo = QComboBox()
+        self.person_combo.addItem('')
+        self.person_combo.addItems([name for _, name in get_person()])
+        self.project_combo = QComboBox()
+        self.project_combo.addItem('')
+        self.project_combo.addItems([name for _, name in get_project()])
+        self.sub_project_combo = QComboBox()
+        self.kind_combo = create_kind_combo(True)
+
+        self.project_combo.currentTextChanged.connect(self.load_sub_projects)
+
+        form_layout = QFormLayout()
+        form_layout.addRow("人员:", self.person_combo)
+        form_layout.addRow("项目:", self.project_combo)
+        form_layout.addRow("子项目:", self.sub_project_combo)
+        form_layout.addRow("类型:", self.kind_combo)
+
+        button_box = QDialogButtonBox()
+        button_box.addButton(QDialogButtonBox.Save).setText("保存")
+        button_box.addButton(QDialogButtonBox.Cancel).setText("取消")
+        button_box.accepted.connect(self.handle_save)
+        button_box.rejected.connect(self.reject)
+
+        layout = QVBoxLayout()
+        layout.addLayout(form_layout)
+        layout.addWidget(button_box)
+        self.setLayout(layout)
+
+    def load_sub_projects(self):
+        self.sub_project_combo.clear()
+        for name, _ in get_sub_project(self.project_combo.currentText()):
+            self.sub_project_combo.addItem(name)
+
+    def handle_save(self):
+        try:
+            self.count = reassign_transfers(
+                self.ids, self.person_combo.currentText(), self.project_combo.currentText(),
+                self.sub_project_combo.currentText(), self.kind_combo.currentText())
+        except Exception as e:
+            QMessageBox.warning(self, "错误", str(e))
+            traceback.print_exc()
+            return
+        self.accept()
+
 class EditPersonDialog(QDialog):
     def __init__(self, person_id):
         super().__init__()
@@ -534,9 +2326,13 @@ class PersonTab(QWidget):
         self.person_table.setEditTriggers(QTableWidget.NoEditTriggers)
         layout.addWidget(self.person_table)
         self.setLayout(layout)
-        self.load()
+        self.loaded_version = None
 
     def load(self):
+        versions = changes.versions("person")
+        if self.loaded_version == versions:
+            return
+        self.loaded_version = versions
         rows = get_person()
         self.person_table.setRowCount(len(rows))
         for row, (id_, name) in enumerate(rows):
@@ -644,7 +2440,57 @@ class EditSubProjectDialog(QDialog):
             update_sub_project(self.parent_id, self.name, name)
             self.accept()
 
+class ProjectTreeView(QTreeView):
+    """
+    dragging selected rows reorders them among their siblings. The drop
+    only reports (parent, rows, row to insert before), ProjectTab writes the
+    order and moves the rows
+    """
+
+    rows_dropped = Signal(QModelIndex, list, int)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setSelectionMode(QTreeView.ExtendedSelection)
+        self.setSelectionBehavior(QTreeView.SelectRows)
+        self.setDragEnabled(True)
+        self.setAcceptDrops(True)
+        self.setDropIndicatorShown(True)
+        self.setDragDropMode(QTreeView.InternalMove)
+
+    @override
+    def dropEvent(self, event):
+        # IgnoreAction keeps both the model and the drag source from moving
+        # or removing rows on their own
+        event.setDropAction(Qt.IgnoreAction)
+        event.accept()
+
+        selected = self.selectionModel().selectedRows(0)
+        if not selected:
+            return
+        parent = selected[0].parent()
+        if any(index.parent() != parent for index in selected):
+            return
+
+        target = self.indexAt(event.position().toPoint())
+        if not target.isValid():
+            row = self.model().rowCount(parent)
+        elif target.siblingAtColumn(0).parent() == parent:
+            row = target.row() + (0 if self.dropIndicatorPosition() == QTreeView.AboveItem else 1)
+        else:
+            # no moving sub_projects across projects
+            return
+        self.rows_dropped.emit(parent, sorted(index.row() for index in selected), row)
+
 class ProjectTab(QWidget):
+    """
+    the tree is a QStandardItemModel with delegate-painted actions, a write
+    only touches the rows it changes instead of rebuilding the tree
+    """
+
+    PROJECT_ACTIONS = ['上移', '下移', '编辑', '删除', '创建子项目']
+    SUB_PROJECT_ACTIONS = ['上移', '下移', '编辑', '删除']
+
     def __init__(self):
         super().__init__()
         layout = QVBoxLayout()
@@ -656,160 +2502,161 @@ class ProjectTab(QWidget):
         add_btn.clicked.connect(self.handle_add)
         layout.addLayout(form)
         layout.addWidget(add_btn)
-        self.project_tree = QTreeWidget()
-        self.project_tree.setColumnCount(2)
-        self.project_tree.setHeaderLabels(["项目名", "操作"])
+        self.project_model = QStandardItemModel(self)
+        self.project_tree = ProjectTreeView()
+        self.project_tree.setModel(self.project_model)
+        self.project_tree.rows_dropped.connect(self.handle_drop)
+        self.project_tree.setEditTriggers(QTreeView.NoEditTriggers)
+        self.action_delegate = ActionButtonDelegate(self.actions_at, self.project_tree, self.action_enabled)
+        self.action_delegate.clicked.connect(self.handle_action)
+        self.project_tree.setItemDelegateForColumn(1, self.action_delegate)
 
         layout.addWidget(self.project_tree)
         self.setLayout(layout)
-        self.load()
+        self.loaded_version = None
 
     def load(self):
-        self.project_tree.clear()
-
-        project_list = []
-        project_id_map = {}
-        for id, name in get_project():
-            project_list.append(name)
-            project_id_map[name] = id
-
-        top_items = {}
-        for i, name in enumerate(project_list):
-            item = QTreeWidgetItem([name, ''])
-            self.project_tree.addTopLevelItem(item)
-
-            up_btn = QPushButton("上移")
-            if i > 0:
-                up_btn.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-                up_btn.clicked.connect(partial(self.handle_move_project, name, project_list[i - 1]))
-            else:
-                up_btn.setDisabled(True)
-
-            down_btn = QPushButton("下移")
-            if i < len(project_list) - 1:
-                down_btn.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-                down_btn.clicked.connect(partial(self.handle_move_project, name, project_list[i + 1]))
-            else:
-                down_btn.setDisabled(True)
-
-            create_btn = QPushButton("创建子项目")
-            create_btn.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-            create_btn.clicked.connect(partial(self.handle_create_sub_project, project_id_map[name]))
-
-            edit_btn = QPushButton("编辑")
-            edit_btn.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-            edit_btn.clicked.connect(partial(self.handle_edit_project, name))
-
-            delete_btn = QPushButton("删除")
-            delete_btn.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-            delete_btn.clicked.connect(partial(self.handle_delete_project, name))
-
-            action_widget = QWidget()
-            action_layout = QHBoxLayout()
-            if up_btn:
-                action_layout.addWidget(up_btn)
-            if down_btn:
-                action_layout.addWidget(down_btn)
-            action_layout.addWidget(edit_btn)
-            action_layout.addWidget(delete_btn)
-            action_layout.addWidget(create_btn)
-            action_layout.addSpacerItem(QSpacerItem(0, 0, QSizePolicy.Expanding, QSizePolicy.Minimum))
-            action_layout.setAlignment(edit_btn, Qt.AlignLeft)
-            action_layout.setAlignment(delete_btn, Qt.AlignLeft)
-            action_layout.setAlignment(create_btn, Qt.AlignLeft)
-            action_widget.setLayout(action_layout)
-            self.project_tree.setItemWidget(item, 1, action_widget)
-            top_items[name] = item
-
-        sub_project_map = defaultdict(list)
-        for name, parent in get_sub_project():
-            sub_project_map[parent].append(name)
-
-        for parent, sub_project_list in sub_project_map.items():
-            for i, name in enumerate(sub_project_list):
-                item = QTreeWidgetItem([name, ''])
-                top_items[parent].addChild(item)
-
-                up_btn = QPushButton("上移")
-                if i > 0:
-                    up_btn.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-                    up_btn.clicked.connect(partial(self.handle_move_sub_project, project_id_map[parent], name, sub_project_list[i - 1]))
-                else:
-                    up_btn.setDisabled(True)
-
-                down_btn = QPushButton("下移")
-                if i < len(sub_project_list) - 1:
-                    down_btn.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-                    down_btn.clicked.connect(partial(self.handle_move_sub_project, project_id_map[parent], name, sub_project_list[i + 1]))
-                else:
-                    down_btn.setDisabled(True)
-
-                edit_btn = QPushButton("编辑")
-                edit_btn.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-                edit_btn.clicked.connect(partial(self.handle_edit_sub_project, project_id_map[parent], name))
-
-                delete_btn = QPushButton("删除")
-                delete_btn.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-                delete_btn.clicked.connect(partial(self.handle_delete_sub_project, project_id_map[parent], name))
-
-                action_widget = QWidget()
-                action_layout = QHBoxLayout()
-                action_layout.addWidget(up_btn)
-                action_layout.addWidget(down_btn)
-                action_layout.addWidget(edit_btn)
-                action_layout.addWidget(delete_btn)
-                action_layout.addSpacerItem(QSpacerItem(0, 0, QSizePolicy.Expanding, QSizePolicy.Minimum))
-                action_layout.setAlignment(up_btn, Qt.AlignLeft)
-                action_layout.setAlignment(down_btn, Qt.AlignLeft)
-                action_layout.setAlignment(edit_btn, Qt.AlignLeft)
-                action_layout.setAlignment(delete_btn, Qt.AlignLeft)
-                action_widget.setLayout(action_layout)
-                self.project_tree.setItemWidget(item, 1, action_widget)
-
+        versions = changes.versions("project", "sub_project")
+        if self.loaded_version == versions:
+            return
+        self.loaded_version = versions
+        dimensions = dimension_cache.get()
+
+        self.project_model.clear()
+        self.project_model.setHorizontalHeaderLabels(["项目名", "操作"])
+        root = self.project_model.invisibleRootItem()
+        for project_id, name in dimensions.projects:
+            row = self.create_row(project_id, name)
+            for sub_project_id, sub_project in dimensions.sub_projects.get(project_id, []):
+                row[0].appendRow(self.create_row(sub_project_id, sub_project))
+            root.appendRow(row)
+
+        self.project_tree.setColumnWidth(0, 200)
         self.project_tree.expandAll()
 
-    def handle_move_project(self, name1, name2):
-        swap_project_order(name1, name2)
-        self.load()
+    def create_row(self, id_, name):
+        item = QStandardItem(name)
+        item.setData(id_, Qt.UserRole)
+        return [item, QStandardItem()]
+
+    def mark_synced(self):
+        # the model already shows the write, no need to reload on next visit
+        self.loaded_version = changes.versions("project", "sub_project")
+
+    def actions_at(self, index):
+        return self.SUB_PROJECT_ACTIONS if index.parent().isValid() else self.PROJECT_ACTIONS
+
+    def action_enabled(self, index, button):
+        if button == 0:
+            return index.row() > 0
+        if button == 1:
+            return index.row() < self.project_model.rowCount(index.parent()) - 1
+        return True
+
+    def handle_action(self, index, button):
+        item = self.project_model.itemFromIndex(index.siblingAtColumn(0))
+        if item.parent() is None:
+            handlers = [
+                partial(self.handle_move_project, item, -1),
+                partial(self.handle_move_project, item, 1),
+                partial(self.handle_edit_project, item),
+                partial(self.handle_delete_project, item),
+                partial(self.handle_create_sub_project, item),
+            ]
+        else:
+            handlers = [
+                partial(self.handle_move_sub_project, item, -1),
+                partial(self.handle_move_sub_project, item, 1),
+                partial(self.handle_edit_sub_project, item),
+                partial(self.handle_delete_sub_project, item),
+            ]
+        handlers[button]()
+
+    def swap_rows(self, parent, row, other):
+        items = parent.takeRow(row)
+        parent.insertRow(other, items)
+        self.project_tree.expand(items[0].index())
+
+    def handle_move_project(self, item, offset):
+        root = self.project_model.invisibleRootItem()
+        other = root.child(item.row() + offset)
+        swap_project_order(item.text(), other.text())
+        self.swap_rows(root, item.row(), other.row())
+        self.mark_synced()
+
+    def handle_move_sub_project(self, item, offset):
+        parent = item.parent()
+        other = parent.child(item.row() + offset)
+        swap_sub_project_order(parent.data(Qt.UserRole), item.text(), other.text())
+        self.swap_rows(parent, item.row(), other.row())
+        self.mark_synced()
+
+    def handle_drop(self, parent_index, rows, row):
+        if parent_index.isValid():
+            parent = self.project_model.itemFromIndex(parent_index)
+        else:
+            parent = self.project_model.invisibleRootItem()
+        # the first row at or after the drop point that is not itself moving
+        while row < parent.rowCount() and row in rows:
+            row += 1
+        before = parent.child(row) if row < parent.rowCount() else None
+        names = [parent.child(r).text() for r in rows]
+        before_name = None if before is None else before.text()
 
-    def handle_move_sub_project(self, parent, name1, name2):
-        swap_sub_project_order(parent, name1, name2)
-        self.load()
+        try:
+            if parent_index.isValid():
+                move_sub_projects(parent.data(Qt.UserRole), names, before_name)
+            else:
+                move_projects(names, before_name)
+        except Exception as e:
+            QMessageBox.warning(self, "错误", str(e))
+            traceback.print_exc()
+            return
 
-    def handle_create_sub_project(self, parent):
-        dialog = CreateSubProjectDialog(parent)
-        dialog.exec()
-        self.load()
+        taken = [parent.takeRow(r) for r in reversed(rows)][::-1]
+        insert_at = parent.rowCount() if before is None else before.row()
+        for offset, items in enumerate(taken):
+            parent.insertRow(insert_at + offset, items)
+            self.project_tree.expand(items[0].index())
+        self.mark_synced()
+
+    def handle_create_sub_project(self, item):
+        project_id = item.data(Qt.UserRole)
+        dialog = CreateSubProjectDialog(project_id)
+        if dialog.exec() == QDialog.Accepted:
+            name = dialog.name_input.text()
+            item.appendRow(self.create_row(dimension_cache.get().sub_project_ids[(project_id, name)], name))
+            self.project_tree.expand(item.index())
+            self.mark_synced()
 
     def handle_add(self):
         name = self.project_name_input.text()
         if name:
             add_project(name)
-            self.load()
+            self.project_model.appendRow(self.create_row(dimension_cache.get().project_ids[name], name))
+            self.mark_synced()
 
-    def handle_edit_project(self, name):
-        dialog = EditProjectDialog(name)
+    def handle_edit_project(self, item):
+        dialog = EditProjectDialog(item.text())
         if dialog.exec() == QDialog.Accepted:
-            self.load()
+            item.setText(dialog.name_input.text())
+            self.mark_synced()
 
-    def handle_add_sub(self):
-        name = self.project_name_input.text()
-        if name:
-            add_project(name)
-            self.load()
-
-    def handle_edit_sub_project(self, parent_id, name):
-        dialog = EditSubProjectDialog(parent_id, name)
+    def handle_edit_sub_project(self, item):
+        dialog = EditSubProjectDialog(item.parent().data(Qt.UserRole), item.text())
         if dialog.exec() == QDialog.Accepted:
-            self.load()
+            item.setText(dialog.name_input.text())
+            self.mark_synced()
 
-    def handle_delete_project(self, name):
+    def handle_delete_project(self, item):
+        name = item.text()
         if not question_box("确认", f"确定要删除 {name} 吗？"):
             return
 
         try:
             delete_project(name)
-            self.load()
+            self.project_model.removeRow(item.row())
+            self.mark_synced()
         except sqlite3.IntegrityError:
             QMessageBox.warning(self, "错误", "存在相关子项目，无法删除")
             traceback.print_exc()
@@ -818,13 +2665,16 @@ class ProjectTab(QWidget):
             traceback.print_exc()
 
 
-    def handle_delete_sub_project(self, parent, name):
+    def handle_delete_sub_project(self, item):
+        name = item.text()
         if not question_box("确认", f"确定要删除 {name} 吗？"):
             return
 
         try:
-            delete_sub_project(parent, name)
-            self.load()
+            parent = item.parent()
+            delete_sub_project(parent.data(Qt.UserRole), name)
+            parent.removeRow(item.row())
+            self.mark_synced()
         except sqlite3.IntegrityError:
             QMessageBox.warning(self, "错误", "存在相关交易记录，无法删除")
             traceback.print_exc()
@@ -833,6 +2683,175 @@ class ProjectTab(QWidget):
             traceback.print_exc()
 
 
+class TransferModel(QAbstractTableModel):
+    """rows are fetched through query_executor, pages show up as they arrive"""
+
+    PAGE_SIZE = TRANSFER_PAGE_SIZE
+    HEADERS = ["时间", "人员", "项目", "子项目", "类型", "金额", "余额", "备注", "操作"]
+    RUNNING_COLUMN = 6
+    ACTION_COLUMN = 8
+
+    loaded = Signal()
+    load_failed = Signal(object)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.filters = TransferFilter()
+        self.rows = []
+        self.total = 0
+        self.fetching = False
+        # running balances of the loaded rows by id, only fetched while shown
+        self.show_running = False
+        self.running = {}
+        self.generation = 0
+
+    def load(self, filters):
+        self.filters = filters
+        self.fetching = True
+        # replaces a load or page request still in flight
+        query_executor.submit(self, partial(transfer_first_page, filters, self.PAGE_SIZE),
+                              self.on_loaded, self.on_failed)
+
+    def on_loaded(self, result):
+        self.beginResetModel()
+        self.total, self.rows = result
+        self.fetching = False
+        self.running = {}
+        self.generation += 1
+        self.endResetModel()
+        self.loaded.emit()
+        self.load_running(self.rows)
+
+    def set_show_running(self, show):
+        self.show_running = show
+        self.load_running(self.rows)
+
+    def load_running(self, rows):
+        if not self.show_running or not rows:
+            return
+        # one request per page, a reload makes the answers still in flight stale
+        query_executor.submit((self, 'running', self.generation, rows[0][0]),
+                              partial(transfer_running_balance, [row[0] for row in rows]),
+                              partial(self.on_running, self.generation))
+
+    def on_running(self, generation, running):
+        if generation != self.generation:
+            return
+        self.running.update(running)
+        self.dataChanged.emit(self.index(0, self.RUNNING_COLUMN), self.index(len(self.rows) - 1, self.RUNNING_COLUMN))
+
+    def on_failed(self, e):
+        self.fetching = False
+        self.load_failed.emit(e)
+
+    def transfer_at(self, row):
+        id_, time, person, project, sub_project, kind, amount, memo = self.rows[row]
+        return id_, time, person or "", project or "", sub_project or "", kind or "", format_amount(amount), memo or ""
+
+    @override
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    @override
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    @override
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid() or index.column() == self.ACTION_COLUMN:
+            return None
+        if index.column() == self.RUNNING_COLUMN:
+            balance = self.running.get(self.rows[index.row()][0])
+            return None if balance is None else format_amount(balance)
+        # transfer_at starts with the id, and has no running balance
+        return self.transfer_at(index.row())[index.column() + (1 if index.column() < self.RUNNING_COLUMN else 0)]
+
+    @override
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.HEADERS[section]
+        return super().headerData(section, orientation, role)
+
+    @override
+    def canFetchMore(self, parent):
+        return not parent.isValid() and len(self.rows) < self.total
+
+    @override
+    def fetchMore(self, parent):
+        if parent.isValid() or self.fetching:
+            return
+        self.fetching = True
+        after = transfer_key(self.rows[-1]) if self.rows else None
+        query_executor.submit(self, partial(filter_transfer, self.filters, after, self.PAGE_SIZE),
+                              self.on_page, self.on_failed)
+
+    def on_page(self, rows):
+        self.fetching = False
+        if not rows:
+            # rows were deleted behind our back, stop asking for more
+            self.total = len(self.rows)
+            return
+        self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(rows) - 1)
+        self.rows.extend(rows)
+        self.endInsertRows()
+        self.load_running(rows)
+
+class ActionButtonDelegate(QStyledItemDelegate):
+    """paint buttons into a cell instead of creating a widget per row"""
+    clicked = Signal(QModelIndex, int)  # index, button index
+
+    BUTTON_PADDING = 16
+
+    def __init__(self, labels, parent=None, enabled=None):
+        super().__init__(parent)
+        # labels is a list, or a function of the index when rows differ.
+        # enabled(index, button) greys out a button when it returns False
+        self.labels = labels
+        self.enabled = enabled
+
+    def labels_at(self, index):
+        return self.labels(index) if callable(self.labels) else self.labels
+
+    def button_rects(self, rect, labels, metrics):
+        rects = []
+        x = rect.x()
+        for label in labels:
+            width = metrics.horizontalAdvance(label) + self.BUTTON_PADDING
+            rects.append(QRect(x, rect.y(), width, rect.height()).adjusted(1, 1, -1, -1))
+            x += width
+        return rects
+
+    def is_enabled(self, index, button):
+        return self.enabled is None or self.enabled(index, button)
+
+    @override
+    def paint(self, painter, option, index):
+        style = option.widget.style() if option.widget else QApplication.style()
+        labels = self.labels_at(index)
+        for i, (label, rect) in enumerate(zip(labels, self.button_rects(option.rect, labels, option.fontMetrics))):
+            button = QStyleOptionButton()
+            button.rect = rect
+            button.text = label
+            button.state = QStyle.State_Enabled if self.is_enabled(index, i) else QStyle.State_None
+            style.drawControl(QStyle.CE_PushButton, button, painter, option.widget)
+
+    @override
+    def sizeHint(self, option, index):
+        labels = self.labels_at(index)
+        width = sum(option.fontMetrics.horizontalAdvance(label) + self.BUTTON_PADDING for label in labels)
+        return QSize(width, option.fontMetrics.height() + 10)
+
+    @override
+    def editorEvent(self, event, model, option, index):
+        if event.type() == QEvent.MouseButtonRelease and event.button() == Qt.LeftButton:
+            labels = self.labels_at(index)
+            for i, rect in enumerate(self.button_rects(option.rect, labels, option.fontMetrics)):
+                if rect.contains(event.position().toPoint()):
+                    if self.is_enabled(index, i):
+                        self.clicked.emit(index, i)
+                    return True
+        return super().editorEvent(event, model, option, index)
+
 class TransferTab(QWidget):
     def __init__(self):
         super().__init__()
@@ -844,6 +2863,8 @@ class TransferTab(QWidget):
         self.person_input = LazyComboBox(lambda :[name for _, name in get_person()])
         self.project_input = LazyComboBox(lambda: [name for _, name in get_project()])
         self.project_balance = QLabel()
+        self.balance_date = create_optional_date_edit()
+        self.balance_date.dateChanged.connect(self.load_balance)
         self.sub_project_input = LazyComboBox(lambda : [name for name, _ in get_sub_project(self.project_input.currentText())])
         self.sub_project_input.setEditable(True)
         self.kind_input = create_kind_combo()
@@ -857,7 +2878,11 @@ class TransferTab(QWidget):
         form.addRow("时间:", self.time_input)
         form.addRow("人员:", self.person_input)
         form.addRow("项目:", self.project_input)
-        form.addRow("余额:", self.project_balance)
+        balance_bar = QHBoxLayout()
+        balance_bar.addWidget(self.project_balance, 1)
+        balance_bar.addWidget(QLabel("截至:"))
+        balance_bar.addWidget(self.balance_date)
+        form.addRow("余额:", balance_bar)
         form.addRow("子项目:", self.sub_project_input)
         form.addRow("类型:", self.kind_input)
         form.addRow("金额:", self.amount_input)
@@ -871,6 +2896,8 @@ class TransferTab(QWidget):
         line.setFrameShadow(QFrame.Sunken)
 
         filter_bar = QHBoxLayout()
+        self.text_filter = QLineEdit()
+        self.text_filter.setPlaceholderText("备注、人员或项目")
         self.person_filter = QLineEdit()
         self.project_filter = QLineEdit()
         self.sub_project_filter = QLineEdit()
@@ -880,14 +2907,30 @@ class TransferTab(QWidget):
 
         export_btn = QPushButton('导出为 excel')
         export_btn.clicked.connect(self.export_to_excel)
-
-        self.filters = ("", "", "", "")
+        import_btn = QPushButton('从 excel/csv 导入')
+        import_btn.clicked.connect(self.import_from_file)
+
+        range_bar = QHBoxLayout()
+        self.date_from_filter = create_optional_date_edit()
+        self.date_to_filter = create_optional_date_edit()
+        self.amount_min_filter = QLineEdit()
+        self.amount_min_filter.setValidator(QDoubleValidator(0.0, float('inf'), 2))
+        self.amount_max_filter = QLineEdit()
+        self.amount_max_filter.setValidator(QDoubleValidator(0.0, float('inf'), 2))
+
+        self.filters = TransferFilter()
         self.filters_label = QLabel()
         def handle_filter():
-            self.filters = (self.person_filter.text(), self.project_filter.text(), self.sub_project_filter.text(), self.kind_filter.currentText())
-            self.load()
+            self.filters = TransferFilter(
+                self.person_filter.text(), self.project_filter.text(), self.sub_project_filter.text(), self.kind_filter.currentText(),
+                optional_date_text(self.date_from_filter), optional_date_text(self.date_to_filter),
+                self.amount_min_filter.text(), self.amount_max_filter.text(), self.text_filter.text())
+            self.load_list()
         filter_btn.clicked.connect(handle_filter)
+        self.text_filter.returnPressed.connect(handle_filter)
 
+        filter_bar.addWidget(QLabel("搜索:"))
+        filter_bar.addWidget(self.text_filter)
         filter_bar.addWidget(QLabel("人员:"))
         filter_bar.addWidget(self.person_filter)
         filter_bar.addWidget(QLabel("项目:"))
@@ -898,24 +2941,77 @@ class TransferTab(QWidget):
         filter_bar.addWidget(self.kind_filter)
         filter_bar.addWidget(filter_btn)
 
+        range_bar.addWidget(QLabel("时间:"))
+        range_bar.addWidget(self.date_from_filter)
+        range_bar.addWidget(QLabel("至"))
+        range_bar.addWidget(self.date_to_filter)
+        range_bar.addWidget(QLabel("金额:"))
+        range_bar.addWidget(self.amount_min_filter)
+        range_bar.addWidget(QLabel("至"))
+        range_bar.addWidget(self.amount_max_filter)
+
         layout.addLayout(form)
         layout.addWidget(add_btn)
         layout.addWidget(line)
         layout.addLayout(filter_bar)
+        layout.addLayout(range_bar)
         layout.addWidget(self.filters_label)
-        layout.addWidget(export_btn)
+        self.running_input = QCheckBox('显示余额')
+        self.running_input.toggled.connect(self.show_running)
+        export_bar = QHBoxLayout()
+        export_bar.addWidget(export_btn)
+        export_bar.addWidget(import_btn)
+        export_bar.addWidget(self.running_input)
+        layout.addLayout(export_bar)
+
+        # each batch action is one transaction over the selected rows
+        self.batch_delete_btn = QPushButton('批量删除')
+        self.batch_delete_btn.clicked.connect(self.handle_batch_delete)
+        self.batch_edit_btn = QPushButton('批量修改')
+        self.batch_edit_btn.clicked.connect(self.handle_batch_edit)
+        self.batch_shift_btn = QPushButton('批量调整日期')
+        self.batch_shift_btn.clicked.connect(self.handle_batch_shift)
+        self.selection_label = QLabel()
+        batch_bar = QHBoxLayout()
+        batch_bar.addWidget(self.selection_label, 1)
+        batch_bar.addWidget(self.batch_delete_btn)
+        batch_bar.addWidget(self.batch_edit_btn)
+        batch_bar.addWidget(self.batch_shift_btn)
+        layout.addLayout(batch_bar)
+
+        self.transfer_model = TransferModel(self)
+        self.transfer_model.loaded.connect(self.show_filters)
+        self.transfer_model.load_failed.connect(self.show_load_error)
+        self.transfer_table = QTableView()
+        self.transfer_table.setModel(self.transfer_model)
+        self.transfer_table.setEditTriggers(QTableView.NoEditTriggers)
+        self.transfer_table.setSelectionBehavior(QTableView.SelectRows)
+        self.transfer_table.setSelectionMode(QTableView.ExtendedSelection)
+        self.transfer_table.selectionModel().selectionChanged.connect(self.show_selection)
+        # a reset drops the selection without selectionChanged
+        self.transfer_model.modelReset.connect(self.show_selection)
+        # fixed row height keeps the view from measuring every row
+        self.transfer_table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.action_delegate = ActionButtonDelegate(['编辑', '删除'], self.transfer_table)
+        self.action_delegate.clicked.connect(self.handle_action)
+        self.transfer_table.setItemDelegateForColumn(TransferModel.ACTION_COLUMN, self.action_delegate)
+        self.transfer_table.setColumnHidden(TransferModel.RUNNING_COLUMN, True)
+        self.transfer_table.doubleClicked.connect(lambda index: self.handle_edit_row(index.row()))
+        self.transfer_table.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.transfer_table.customContextMenuRequested.connect(self.show_context_menu)
 
-        self.transfer_table = QTableWidget()
-        headers = ["时间", "人员", "项目", "子项目", "类型", "金额", "备注", "操作"]
-        self.transfer_table.setColumnCount(len(headers))
-        self.transfer_table.setHorizontalHeaderLabels(headers)
-    
         layout.addWidget(self.transfer_table)
         self.setLayout(layout)
-        self.load()
+        self.loaded_version = None
+        self.show_selection()
 
     def load_balance(self):
-        sub_project_balance = get_balance(self.person_input.currentText(), self.project_input.currentText())
+        query_executor.submit((self, 'balance'),
+                              partial(get_balance, self.person_input.currentText(), self.project_input.currentText(),
+                                      optional_date_text(self.balance_date)),
+                              self.show_balance)
+
+    def show_balance(self, sub_project_balance):
         self.project_balance.clear()
         content = [f'合计: {sum(sub_project_balance.values())}']
         for sub_project, balance in sub_project_balance.items():
@@ -923,51 +3019,69 @@ class TransferTab(QWidget):
         self.project_balance.setText(', '.join(content))
 
     def load_list(self):
-        TIME_CELL = 0
-        PERSON_CELL = 1
-        PROJECT_CELL = 2
-        SUB_PROJECT_CELL = 3
-        KIND_CELL = 4
-        AMOUNT_CELL = 5
-        MEMO_CELL = 6
-        ACTION_CELL = 7
-
-        rows = filter_transfer(*self.filters)
-
-        if self.filters != ("", "", "", ""):
-            self.filters_label.setText(f"{len(rows)} 条结果, 过滤条件: {','.join([x for x in self.filters if x])}")
+        self.transfer_model.load(self.filters)
+
+    def show_running(self, show):
+        self.transfer_table.setColumnHidden(TransferModel.RUNNING_COLUMN, not show)
+        self.transfer_model.set_show_running(show)
+
+    def show_load_error(self, e):
+        if isinstance(e, InvalidInputError):
+            QMessageBox.warning(self, "错误", str(e))
         else:
-            self.filters_label.setText(f"{len(rows)} 条结果, 未过滤")
+            traceback.print_exception(e)
 
-        self.transfer_table.setRowCount(len(rows))
+    def show_filters(self):
+        total = self.transfer_model.total
+        filters = self.transfer_model.filters
 
-        for row, (id_, time, person, project, sub_project, kind, amount, memo) in enumerate(rows):
-            action_cell_widget = QWidget()
+        if not filters.is_empty():
+            self.filters_label.setText(f"{total} 条结果, 过滤条件: {','.join(filters.describe())}")
+        else:
+            self.filters_label.setText(f"{total} 条结果, 未过滤")
 
-            layout = QHBoxLayout(action_cell_widget)
-            edit_btn = QPushButton('编辑')
-            delete_btn = QPushButton("删除")
-            layout.setContentsMargins(0, 0, 0, 0)
-            layout.setSpacing(2)
+    def selected_ids(self):
+        return [self.transfer_model.transfer_at(index.row())[0] for index in self.transfer_table.selectionModel().selectedRows()]
+
+    def show_selection(self):
+        count = len(self.transfer_table.selectionModel().selectedRows())
+        self.selection_label.setText(f"已选 {count} 条" if count else "")
+        for btn in (self.batch_delete_btn, self.batch_edit_btn, self.batch_shift_btn):
+            btn.setEnabled(count > 0)
 
-            edit_btn.clicked.connect(partial(self.handle_edit, id_, time, person, project, sub_project, kind, amount, memo))
-            delete_btn.clicked.connect(partial(self.handle_delete, id_))
+    def show_context_menu(self, pos):
+        index = self.transfer_table.indexAt(pos)
+        if not index.isValid():
+            return
+        menu = QMenu(self)
+        if len(self.transfer_table.selectionModel().selectedRows()) > 1:
+            menu.addAction('批量删除', self.handle_batch_delete)
+            menu.addAction('批量修改', self.handle_batch_edit)
+            menu.addAction('批量调整日期', self.handle_batch_shift)
+        else:
+            menu.addAction('编辑', partial(self.handle_edit_row, index.row()))
+            menu.addAction('删除', partial(self.handle_delete_row, index.row()))
+        menu.exec(self.transfer_table.viewport().mapToGlobal(pos))
 
-            layout.addWidget(edit_btn)
-            layout.addWidget(delete_btn)
+    def handle_action(self, index, button):
+        if button == 0:
+            self.handle_edit_row(index.row())
+        else:
+            self.handle_delete_row(index.row())
 
-            self.transfer_table.setItem(row, TIME_CELL, QTableWidgetItem(time))
-            self.transfer_table.setItem(row, PERSON_CELL, QTableWidgetItem(person or ""))
-            self.transfer_table.setItem(row, PROJECT_CELL, QTableWidgetItem(project or ""))
-            self.transfer_table.setItem(row, SUB_PROJECT_CELL, QTableWidgetItem(sub_project or ""))
-            self.transfer_table.setItem(row, KIND_CELL, QTableWidgetItem(kind or ""))
-            self.transfer_table.setItem(row, AMOUNT_CELL, QTableWidgetItem(str(amount)))
-            self.transfer_table.setItem(row, MEMO_CELL, QTableWidgetItem(memo or ""))
-            self.transfer_table.setCellWidget(row, ACTION_CELL, action_cell_widget)
+    def handle_edit_row(self, row):
+        self.handle_edit(*self.transfer_model.transfer_at(row))
 
-            self.transfer_table.setEditTriggers(QTableWidget.NoEditTriggers)
+    def handle_delete_row(self, row):
+        self.handle_delete(self.transfer_model.transfer_at(row)[0])
 
     def load(self):
+        # the list and the balance show names too, so every table counts
+        versions = changes.versions(*TABLES)
+        if self.loaded_version == versions:
+            return
+        self.loaded_version = versions
+        self.load_balance()
         self.load_list()
 
 
@@ -985,14 +3099,12 @@ class TransferTab(QWidget):
             QMessageBox.warning(self, "错误", str(e))
             traceback.print_exc()
             return
-        self.load_balance()
-        self.load_list()
+        self.load()
 
     def handle_edit(self, id_, time, person, project, sub_project, kind, amount, memo):
         dialog = EditTranferDialog(id_, time, person, project, sub_project, kind, amount, memo)
         if dialog.exec() == QDialog.Accepted:
-            self.load_balance()
-            self.load_list()
+            self.load()
 
     def handle_delete(self, id_):
         if not question_box("确认", "确定要删除交易记录吗？"):
@@ -1004,30 +3116,68 @@ class TransferTab(QWidget):
             QMessageBox.warning(self, "错误", str(e))
             traceback.print_exc()
             return
-        self.load_balance()
-        self.load_list()
+        self.load()
 
-    def export_to_excel(self):
+    def handle_batch_delete(self):
+        ids = self.selected_ids()
+        if not ids or not question_box("确认", f"确定要删除选中的 {len(ids)} 条交易记录吗？"):
+            return
+
+        try:
+            delete_transfers(ids)
+        except Exception as e:
+            QMessageBox.warning(self, "错误", str(e))
+            traceback.print_exc()
+            return
+        self.load()
+
+    def handle_batch_edit(self):
+        ids = self.selected_ids()
+        if ids and BatchEditDialog(ids).exec() == QDialog.Accepted:
+            self.load()
+
+    def handle_batch_shift(self):
+        ids = self.selected_ids()
+        if not ids:
+            return
+        days, ok = QInputDialog.getInt(self, "批量调整日期", f"选中的 {len(ids)} 条顺延天数 (负数提前):", 0, -36500, 36500)
+        if not ok or not days:
+            return
+
+        try:
+            shift_transfers(ids, days)
+        except Exception as e:
+            QMessageBox.warning(self, "错误", str(e))
+            traceback.print_exc()
+            return
+        self.load()
+
+    def import_from_file(self):
         options = QFileDialog.Options()
-        file_name, _ = QFileDialog.getSaveFileName(self, "导出为 Excel 文件", "", "Excel Files (*.xlsx);;All Files (*)", options=options)
+        file_name, _ = QFileDialog.getOpenFileName(self, "导入流水", "", "Excel Files (*.xlsx);;CSV Files (*.csv);;All Files (*)", options=options)
 
         if not file_name:
             return
 
-        wb = excel_from_table(self.transfer_table, "流水记录", False)
-        msg_content = "导出成功，文件已保存到 {}".format(file_name)
         try:
-            # Save the workbook to a file
-            wb.save(file_name)
+            count = import_transfer_file(file_name)
         except Exception as e:
-            msg_content = "导出失败，错误信息：{}".format(str(e))
+            QMessageBox.warning(self, "错误", f"导入失败，错误信息：{e}")
+            traceback.print_exc()
+            return
+        QMessageBox.information(self, "导入结果", f"导入成功，共 {count} 条")
+        self.load()
 
-        msg = QMessageBox()
-        msg.setIcon(QMessageBox.Information)
-        msg.setText(msg_content)
-        msg.setWindowTitle("导出结果")
-        msg.setStandardButtons(QMessageBox.Ok)
-        msg.exec()
+    def export_to_excel(self):
+        options = QFileDialog.Options()
+        file_name, _ = QFileDialog.getSaveFileName(self, "导出为 Excel 文件", "", "Excel Files (*.xlsx);;All Files (*)", options=options)
+
+        if not file_name:
+            return
+
+        # the model already counted the rows of the current filter
+        start_export(self, file_name, self.transfer_model.total,
+                     partial(excel_from_transfers, self.transfer_model.filters, "流水记录"))
 
 class SummaryTab(QWidget):
     def __init__(self):
@@ -1035,55 +3185,73 @@ class SummaryTab(QWidget):
         layout = QVBoxLayout()
         self.btn = QPushButton("导出为 Excel")
         self.btn.clicked.connect(self.export_to_excel)
+        # blank shows the current balance
+        self.as_of_input = create_optional_date_edit()
+        self.as_of_input.dateChanged.connect(self.load)
+        self.period_input = QComboBox()
+        for text, period in [('总计', None), ('按月', 'month'), ('按季度', 'quarter'), ('按年', 'year')]:
+            self.period_input.addItem(text, period)
+        self.period_input.currentIndexChanged.connect(self.load)
+        self.group_input = QComboBox()
+        self.group_input.addItem('人员', 'person')
+        self.group_input.addItem('子项目', 'sub_project')
+        self.group_input.currentIndexChanged.connect(self.load)
+        self.running_input = QCheckBox('累计余额')
+        self.running_input.toggled.connect(self.load)
+        self.from_input = create_optional_date_edit()
+        self.from_input.dateChanged.connect(self.load)
         self.summary_table = QTableWidget()
         self.summary_table.setEditTriggers(QTableWidget.NoEditTriggers)
         # self.summary_table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
-        layout.addWidget(self.btn)
+        top_bar = QHBoxLayout()
+        top_bar.addWidget(QLabel("汇总:"))
+        top_bar.addWidget(self.period_input)
+        top_bar.addWidget(QLabel("分组:"))
+        top_bar.addWidget(self.group_input)
+        top_bar.addWidget(self.running_input)
+        top_bar.addWidget(QLabel("从:"))
+        top_bar.addWidget(self.from_input)
+        top_bar.addWidget(QLabel("截至:"))
+        top_bar.addWidget(self.as_of_input)
+        top_bar.addStretch()
+        top_bar.addWidget(self.btn)
+        layout.addLayout(top_bar)
         layout.addWidget(self.summary_table)
         self.setLayout(layout)
-
-    def get_project_order(self):
-        project_list = [name for _, name in get_project()]
-        project_map = defaultdict(list)
-        for sub_project, project in get_sub_project():
-            project_map[project].append(sub_project)
-        r = []
-        for parent in project_list:
-            for sub_project in project_map[parent]:
-                r.append(f'{parent}\n{sub_project}')
-        return r
-
+        self.rendered_version = None
+
+    def query(self):
+        """(key, fn, render) for what the inputs currently ask for"""
+        period = self.period_input.currentData()
+        as_of = optional_date_text(self.as_of_input)
+        for widget in (self.group_input, self.running_input, self.from_input):
+            widget.setEnabled(period is not None)
+        if period is None:
+            return (as_of,), partial(get_summary_pivot, as_of), self.render
+        group = self.group_input.currentData()
+        date_from = optional_date_text(self.from_input)
+        return ((period, group, date_from, as_of, self.running_input.isChecked()),
+                partial(get_period_summary, period, group, date_from, as_of), self.render_periods)
 
     def load(self):
-        transfer_list = get_transfer()
-
-        person_order = [name for _, name in get_person()]
-        person_summary = defaultdict(lambda: defaultdict(decimal.Decimal))
-        for person in person_order:
-            person_summary[person]['入'] = 0
-            person_summary[person]['出'] = 0
-
-        project_order = self.get_project_order()
-        project_summary = {project: 0 for project in project_order}
-
-        summary = defaultdict(decimal.Decimal)
-        for person in person_order:
-            for project in project_order:
-                summary[(person, '入', project)] = 0
-                summary[(person, '出', project)] = 0
+        key, fn, render = self.query()
+        version = (changes.versions(*TABLES), key)
+        if self.rendered_version == version:
+            return
+        self.rendered_version = version
+        query_executor.submit(self, fn, render, self.load_failed)
 
-        for row, (id_, time, person, project, sub_project, kind, amount, memo) in enumerate(transfer_list):
-            amount = decimal.Decimal(amount)
-            summary[(person, kind, f'{project}\n{sub_project}')] += amount
-            person_summary[person][kind] += amount
-            project_summary[f'{project}\n{sub_project}'] += kind_sign(kind) * amount
+    def load_failed(self, e):
+        self.rendered_version = None
+        traceback.print_exception(e)
 
+    def render(self, pivot):
         self.summary_table.clear()
         self.summary_table.clearSpans()
 
-        horizontal_headers = project_order + ['人员统计', '人员合计']
+        horizontal_headers = [f'{project}\n{sub_project}' for _, project, sub_project in pivot.columns] + ['人员统计', '人员合计']
         vertial_headers = []
-        for person in person_order:
+        for _, person in pivot.persons:
             vertial_headers.append(f'{person} 入')
             vertial_headers.append(f'出')
         vertial_headers.append('项目合计')
@@ -1091,32 +3259,46 @@ class SummaryTab(QWidget):
         self.summary_table.setRowCount(len(vertial_headers))
         self.summary_table.setColumnCount(len(horizontal_headers))
         self.summary_table.setVerticalHeaderLabels(vertial_headers)
-        self.summary_table.setHorizontalHeaderLabels(horizontal_headers)            
+        self.summary_table.setHorizontalHeaderLabels(horizontal_headers)
 
         for col in range(self.summary_table.rowCount()):
             self.summary_table.verticalHeaderItem(col).setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
 
+        person_col = len(pivot.columns)
+        for x, (person_id, _) in enumerate(pivot.persons):
+            for col, (sub_project_id, _, _) in enumerate(pivot.columns):
+                income, spend = pivot.cell(person_id, sub_project_id)
+                self.summary_table.setItem(x * 2, col, QTableWidgetItem(format_amount(income)))
+                self.summary_table.setItem(x * 2 + 1, col, QTableWidgetItem(format_amount(spend)))
 
-        for col, project in enumerate(project_order):
-            for x, person in enumerate(person_order):
-                self.summary_table.setItem(x * 2, col, QTableWidgetItem(str(summary[(person, "入账", project)])))
-                self.summary_table.setItem(x * 2 + 1, col, QTableWidgetItem(str(summary[(person, "出账", project)])))
+            income, spend = pivot.person_totals[person_id]
+            self.summary_table.setItem(x * 2, person_col, QTableWidgetItem(format_amount(income)))
+            self.summary_table.setItem(x * 2 + 1, person_col, QTableWidgetItem(format_amount(spend)))
+            self.summary_table.setItem(x * 2, person_col + 1, QTableWidgetItem(format_amount(income - spend)))
+            self.summary_table.setSpan(x * 2, person_col + 1, 2, 1)
 
-        for x, person in enumerate(person_order):
-            income = person_summary[person]["入账"]
-            spend = person_summary[person]["出账"]
-            self.summary_table.setItem(x * 2, len(project_summary), QTableWidgetItem(str(income)))
-            self.summary_table.setItem(x * 2 + 1, len(project_summary), QTableWidgetItem(str(spend)))
-            self.summary_table.setItem(x * 2, len(project_summary) + 1, QTableWidgetItem(str(income - spend)))
-            self.summary_table.setSpan(x * 2, len(project_summary) + 1, 2, 1)
-            # print('set span', x * 2, len(project_summary) + 1, 2, 1)
+        total_row = len(vertial_headers) - 1
+        for col, (sub_project_id, _, _) in enumerate(pivot.columns):
+            self.summary_table.setItem(total_row, col, QTableWidgetItem(format_amount(pivot.column_totals[sub_project_id])))
 
-        for col, project in enumerate(project_order):
-            self.summary_table.setItem(2 * len(person_summary), col, QTableWidgetItem(str(project_summary[project])))
+        self.summary_table.setItem(total_row, person_col, QTableWidgetItem(format_amount(pivot.total())))
+        self.summary_table.setSpan(total_row, person_col, 1, 2)
 
-        self.summary_table.setItem(len(vertial_headers) - 1, len(project_summary), QTableWidgetItem(str(sum(project_summary.values()))))
-        self.summary_table.setSpan(len(vertial_headers) - 1, len(project_summary), 1, 2)
-        # print('set span', len(vertial_headers) - 1, len(project_summary), 1, 2)
+    def render_periods(self, summary):
+        self.summary_table.clear()
+        self.summary_table.clearSpans()
+
+        running = self.running_input.isChecked()
+        headers = summary.headers(running)
+        table = summary.table(running)
+        self.summary_table.setRowCount(len(table))
+        self.summary_table.setColumnCount(len(headers))
+        self.summary_table.setHorizontalHeaderLabels(headers)
+        self.summary_table.setVerticalHeaderLabels([label for label, _ in table])
+
+        for row, (_, values) in enumerate(table):
+            for col, value in enumerate(values):
+                self.summary_table.setItem(row, col, QTableWidgetItem(format_amount(value)))
 
     def export_to_excel(self):
         options = QFileDialog.Options()
@@ -1125,82 +3307,15 @@ class SummaryTab(QWidget):
         if not file_name:
             return
 
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.title = "流水统计"
-
-        # Get the headers from the table and add them to the first and second row in the sheet
-        for col in range(self.summary_table.columnCount()):
-            header_lines = self.summary_table.horizontalHeaderItem(col).text().split('\n')
-            ws.cell(row=1, column=col+3, value=header_lines[0])
-            if len(header_lines) > 1:
-                ws.cell(row=2, column=col+3, value=header_lines[1])
-
-        # merge adjacent cells with identical value at first row
-        project_start_col = 3
-        for col in range(4, self.summary_table.columnCount() + 2):
-            if ws.cell(row=1, column=col).value != ws.cell(row=1, column=col-1).value:
-                ws.merge_cells(start_row=1, start_column=project_start_col, end_row=1, end_column=col - 1)
-                ws.cell(row=1, column=project_start_col).alignment = openpyxl.styles.Alignment(horizontal='center', vertical='center')
-                project_start_col = col
-
-        # Get the vertical headers (row headers) and add them to the first and second column
-        for row in range(self.summary_table.rowCount()):
-            header_sections = self.summary_table.verticalHeaderItem(row).text().split(' ', 1)
-            if len(header_sections) == 2:
-                ws.cell(row=row+3, column=1, value=header_sections[0])
-                ws.cell(row=row+3, column=2, value=header_sections[1])
-            else:
-                ws.cell(row=row+3, column=2, value=header_sections[0])
-
-        # merge adjacent cells that belong to same person
-        for row in range(3, self.summary_table.rowCount() + 2, 2):
-            ws.merge_cells(start_row=row, start_column=1, end_row=row+1, end_column=1)
-            ws.cell(row=row, column=1).alignment = openpyxl.styles.Alignment(horizontal='center', vertical='center')
-            ws.merge_cells(start_row=row, start_column=self.summary_table.columnCount() + 2, end_row=row+1, end_column=self.summary_table.columnCount() + 2)
-            ws.cell(row=row, column=self.summary_table.columnCount() + 2).alignment = openpyxl.styles.Alignment(horizontal='center', vertical='center')
-
-        # Get the table data and add it to the sheet starting from row 2
-        for row in range(self.summary_table.rowCount()):
-            for col in range(self.summary_table.columnCount()):
-                item = self.summary_table.item(row, col)
-                if item:
-                    ws.cell(row=row+3, column=col+3, value= decimal.Decimal(item.text()))
-                    ws.cell(row=row+3, column=col+3).alignment = openpyxl.styles.Alignment(horizontal='center', vertical='center')
-
-        # merge blank cells at topleft
-        ws.merge_cells(start_row=1, start_column=1, end_row=2, end_column=2)
-
-        # merge '项目合计'
-        ws.cell(row=self.summary_table.rowCount() + 2, column=1, value='项目合计')
-        ws.merge_cells(start_row=self.summary_table.rowCount() + 2, start_column=1, end_row=self.summary_table.rowCount() + 2, end_column=2)
-        ws.cell(row=self.summary_table.rowCount() + 2, column=1).alignment = openpyxl.styles.Alignment(horizontal='center', vertical='center')
-
-        # merge '人员统计'
-        ws.merge_cells(start_row=1, start_column=self.summary_table.columnCount() + 1, end_row=2, end_column=self.summary_table.columnCount() + 1)
-        ws.cell(row=1, column=self.summary_table.columnCount() + 1).alignment = openpyxl.styles.Alignment(horizontal='center', vertical='center')
-
-        # merge '人员合计'
-        ws.merge_cells(start_row=1, start_column=self.summary_table.columnCount() + 2, end_row=2, end_column=self.summary_table.columnCount() + 2)
-        ws.cell(row=1, column=self.summary_table.columnCount() + 2).alignment = openpyxl.styles.Alignment(horizontal='center', vertical='center')
-
-        # merge bottomright 2 cells
-        ws.merge_cells(start_row=self.summary_table.rowCount() + 2, start_column=self.summary_table.columnCount() + 1, end_row=self.summary_table.rowCount() + 2, end_column=self.summary_table.columnCount() + 2)
-        ws.cell(row=self.summary_table.rowCount() + 2, column=self.summary_table.columnCount() + 1).alignment = openpyxl.styles.Alignment(horizontal='center', vertical='center')
-
-        msg_content = "导出成功，文件已保存到 {}".format(file_name)
-        try:
-            # Save the workbook to a file
-            wb.save(file_name)
-        except Exception as e:
-            msg_content = "导出失败，错误信息：{}".format(str(e))
-
-        msg = QMessageBox()
-        msg.setIcon(QMessageBox.Information)
-        msg.setText(msg_content)
-        msg.setWindowTitle("导出结果")
-        msg.setStandardButtons(QMessageBox.Ok)
-        msg.exec()
+        _, fn, render = self.query()
+        if render == self.render:
+            start_export(self, file_name, len(get_person()),
+                         lambda progress: excel_from_summary(fn(), progress))
+        else:
+            running = self.running_input.isChecked()
+            rows = get_person() if self.group_input.currentData() == 'person' else get_sub_project()
+            start_export(self, file_name, len(rows) + 1,
+                         lambda progress: excel_from_period_summary(fn(), running, progress))
 
 class SettingTab(QWidget):
     def __init__(self):
@@ -1226,70 +3341,334 @@ class SettingTab(QWidget):
     def load(self):
         pass
 
-class EmittingStream(QObject):
-    text_written = Signal(str)
+class LogSink:
+    """
+    stands in for stdout and stderr. A write only appends to a bounded
+    buffer, DebugTab drains it on a timer so a burst of prints costs one
+    view update, and lines beyond size are dropped oldest first
+    """
+
+    def __init__(self, size):
+        self.lines = deque(maxlen=size)
+        self.partial = ''
+        self.dropped = 0
+        # print can run on a worker thread
+        self.lock = threading.Lock()
 
     def write(self, text):
-        self.text_written.emit(str(text))
+        text = str(text)
+        with self.lock:
+            *lines, self.partial = (self.partial + text).split('\n')
+            self.dropped += max(0, len(self.lines) + len(lines) - self.lines.maxlen)
+            self.lines.extend(lines)
+        return len(text)
 
     def flush(self):
         pass
 
-class DebugTab(QTextEdit):
+    def drain(self):
+        """return (complete lines written since the last drain, how many were dropped)"""
+        with self.lock:
+            lines = list(self.lines)
+            dropped = self.dropped
+            self.lines.clear()
+            self.dropped = 0
+        return lines, dropped
+
+class DebugTab(QWidget):
+    TRACE_LEVELS = [('关闭', TRACE_OFF), ('语句', TRACE_SQL), ('耗时', TRACE_TIMING)]
+    LOG_LINES = 5000
+    LOG_FLUSH_MS = 200
+
     def __init__(self):
         super().__init__()
-        self.setReadOnly(True)
+        self.log_view = QPlainTextEdit()
+        self.log_view.setReadOnly(True)
+        # the view drops its oldest lines past this, text never piles up
+        self.log_view.setMaximumBlockCount(self.LOG_LINES)
+
+        self.trace_combo = QComboBox()
+        for label, level in self.TRACE_LEVELS:
+            self.trace_combo.addItem(label, level)
+        self.trace_combo.setCurrentIndex(sql_tracer.level)
+        self.trace_combo.currentIndexChanged.connect(lambda _: sql_tracer.set_level(self.trace_combo.currentData()))
+        refresh_btn = QPushButton("刷新")
+        refresh_btn.clicked.connect(self.load)
+        clear_btn = QPushButton("清空")
+        clear_btn.clicked.connect(self.handle_clear)
+
+        self.trace_table = QTableWidget()
+        self.trace_table.setColumnCount(4)
+        self.trace_table.setHorizontalHeaderLabels(["时间", "耗时(ms)", "SQL", "参数"])
+        self.trace_table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.trace_table.horizontalHeader().setSectionResizeMode(2, QHeaderView.Stretch)
+
+        trace_bar = QHBoxLayout()
+        trace_bar.addWidget(QLabel("SQL 跟踪:"))
+        trace_bar.addWidget(self.trace_combo)
+        trace_bar.addWidget(refresh_btn)
+        trace_bar.addWidget(clear_btn)
+        trace_bar.addStretch()
+
+        layout = QVBoxLayout()
+        layout.addLayout(trace_bar)
+        layout.addWidget(self.trace_table)
+        layout.addWidget(self.log_view)
+        self.setLayout(layout)
+
+        print('redirecting stdout and stderr to the debug tab')
+
+        self.log_sink = LogSink(self.LOG_LINES)
+        sys.stdout = self.log_sink
+        sys.stderr = self.log_sink
+        self.log_timer = QTimer(self)
+        self.log_timer.timeout.connect(self.flush_log)
+        self.log_timer.start(self.LOG_FLUSH_MS)
+
+        # new trace records refresh the table at most once per LOG_FLUSH_MS
+        self.trace_timer = QTimer(self)
+        self.trace_timer.setSingleShot(True)
+        self.trace_timer.timeout.connect(self.load)
+        sql_tracer.recorded.connect(lambda: self.trace_timer.start(self.LOG_FLUSH_MS))
+
+    def flush_log(self):
+        lines, dropped = self.log_sink.drain()
+        if dropped:
+            lines.insert(0, f'... 省略 {dropped} 行')
+        if lines:
+            self.log_view.appendPlainText('\n'.join(lines))
+
+    def handle_clear(self):
+        sql_tracer.clear()
+        self.load()
 
-        print('redirecting stdout and stderr to QTextEdit')
+    def load(self):
+        records = sql_tracer.snapshot()
+        self.trace_table.setRowCount(len(records))
+        for row, (timestamp, duration, sql, params) in enumerate(reversed(records)):
+            self.trace_table.setItem(row, 0, QTableWidgetItem(time.strftime('%H:%M:%S', time.localtime(timestamp))))
+            self.trace_table.setItem(row, 1, QTableWidgetItem('' if duration is None else f'{duration * 1000:.3f}'))
+            self.trace_table.setItem(row, 2, QTableWidgetItem(' '.join(sql.split())))
+            self.trace_table.setItem(row, 3, QTableWidgetItem('' if params is None else str(params)))
 
-        sys.stdout = EmittingStream()
-        sys.stderr = EmittingStream()
-        sys.stdout.text_written.connect(self.append_text)
-        sys.stderr.text_written.connect(self.append_text)
 
-    def append_text(self, text):
-        self.moveCursor(QTextCursor.End)
-        self.insertPlainText(text)
+class LazyTab(QWidget):
+    """builds the tab from factory and loads it the first time it is shown"""
+
+    def __init__(self, factory):
+        super().__init__()
+        self.factory = factory
+        self.tab = None
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.setLayout(layout)
 
     def load(self):
-        pass
+        if self.tab is None:
+            self.tab = self.factory()
+            self.layout().addWidget(self.tab)
+        self.tab.load()
+
+    @override
+    def showEvent(self, event):
+        super().showEvent(event)
+        if self.tab is None:
+            self.load()
 
+# --startup-check fails when the first paint takes longer than this
+STARTUP_BUDGET_MS = 2000
 
 class LedgerApp(QWidget):
-    def __init__(self):
-        super().__init__()
+    first_painted = Signal(float)  # ms since STARTED
 
-        # debug_tab = DebugTab()
+    def __init__(self, debug=False):
+        super().__init__()
 
         self.setMinimumSize(1000, 800)
         self.setWindowTitle("账本应用")
 
         layout = QVBoxLayout()
 
+        # only the visible tab is built before the first paint
         self.tabs = QTabWidget()
-        self.tabs.addTab(PersonTab(), "人员")
-        self.tabs.addTab(ProjectTab(), "项目")
-        self.tabs.addTab(TransferTab(), "流水")
-        self.tabs.addTab(SummaryTab(), "统计")
-        self.tabs.addTab(SettingTab(), "设置")
-        # self.tabs.addTab(debug_tab, "调试")
+        self.tabs.addTab(LazyTab(PersonTab), "人员")
+        self.tabs.addTab(LazyTab(ProjectTab), "项目")
+        self.tabs.addTab(LazyTab(TransferTab), "流水")
+        self.tabs.addTab(LazyTab(SummaryTab), "统计")
+        self.tabs.addTab(LazyTab(SettingTab), "设置")
+        if debug:
+            # built right away so it catches the output from startup on
+            self.tabs.addTab(DebugTab(), "调试")
 
         self.tabs.currentChanged.connect(self.on_tab_changed)
 
         layout.addWidget(self.tabs)
         self.setLayout(layout)
+        self.first_paint_ms = None
+
+    @override
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if self.first_paint_ms is None:
+            self.first_paint_ms = (time.perf_counter() - STARTED) * 1000
+            print(f'[startup] first paint after {self.first_paint_ms:.0f} ms')
+            self.first_painted.emit(self.first_paint_ms)
 
     def on_tab_changed(self, index):
         print('tab change', self.tabs.tabText(index))
         self.tabs.widget(index).load()
 
-if __name__ == "__main__":
-    if len(sys.argv) > 1 and sys.argv[1] == "--drop":
-        init_db(True)
-    else:
-        init_db(False)
+def time_call(fn, repeat):
+    """min / median / max wall time of fn over repeat runs, in ms"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return {"repeat": repeat, "min_ms": round(times[0], 3), "median_ms": round(times[len(times) // 2], 3), "max_ms": round(times[-1], 3)}
+
+def wait_queries(app):
+    while query_executor.busy():
+        app.processEvents(QEventLoop.AllEvents | QEventLoop.WaitForMoreEvents)
+
+def time_tab_load(app, factory):
+    """first load of a fresh tab until its queries have rendered, then a load with nothing changed"""
+    tab = factory()
+    def load():
+        tab.load()
+        wait_queries(app)
+    result = {"load": time_call(load, 1), "reload": time_call(load, 1)}
+    # the tab holds reference cycles through its slots. Left to the cyclic
+    # collector it may be freed on a pool thread, which crashes Qt, so it
+    # is destroyed and collected here on the GUI thread
+    tab.deleteLater()
+    app.sendPostedEvents(None, QEvent.DeferredDelete)
+    del tab, load
+    gc.collect()
+    return result
+
+def run_benchmarks(app, repeat=5):
+    """time the data layer, the exports and every tab load against the open database"""
+    first = filter_transfer(TransferFilter(), limit=1)
+    if not first:
+        raise InvalidInputError('没有流水，先用 --generate 生成')
+    id_, time_, person, project, sub_project, kind, amount, memo = first[0]
+    # a date in the middle of the ledger for the as-of queries
+    low, high = cursor.execute("SELECT MIN(time), MAX(time) FROM transfer").fetchone()
+    middle = (datetime.date.fromisoformat(low) + (datetime.date.fromisoformat(high) - datetime.date.fromisoformat(low)) / 2).isoformat()
+
+    results = {}
+    results["add_transfer"] = time_call(
+        lambda: add_transfer(high, person, project, sub_project, '入账', '1', 'bench'), repeat)
+    added = [added_id for (added_id,) in cursor.execute("SELECT id FROM transfer ORDER BY id DESC LIMIT ?", (repeat,)).fetchall()]
+    results["delete_transfer"] = time_call(lambda: delete_transfer(added.pop()), repeat)
+    # rewriting a row with its own values does the full work and leaves the ledger as it was
+    results["update_transfer"] = time_call(
+        lambda: update_transfer(id_, time_, person, project, sub_project, kind, format_amount(amount), memo), repeat)
+    results["filter_transfer"] = time_call(lambda: filter_transfer(TransferFilter()), repeat)
+    results["filter_transfer_person"] = time_call(lambda: filter_transfer(TransferFilter(person=person)), repeat)
+    results["filter_transfer_text"] = time_call(lambda: filter_transfer(TransferFilter(text=memo)), repeat)
+    results["count_transfer"] = time_call(lambda: count_transfer(TransferFilter()), repeat)
+    results["get_balance"] = time_call(lambda: get_balance(person, project), repeat)
+    results["get_balance_as_of"] = time_call(lambda: get_balance(person, project, middle), repeat)
+    results["get_summary_pivot"] = time_call(get_summary_pivot, repeat)
+    results["get_summary_pivot_as_of"] = time_call(lambda: get_summary_pivot(middle), repeat)
+    results["get_period_summary_month"] = time_call(lambda: get_period_summary('month', 'person'), repeat)
+
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, 'bench.xlsx')
+        results["excel_from_transfers"] = time_call(
+            lambda: excel_from_transfers(TransferFilter(), "流水记录").save(file_name), 1)
+        results["excel_from_summary"] = time_call(lambda: excel_from_summary(get_summary_pivot()).save(file_name), 1)
+
+    for factory in (PersonTab, ProjectTab, TransferTab, SummaryTab):
+        results[factory.__name__] = time_tab_load(app, factory)
+
+    dimensions = dimension_cache.get()
+    return {
+        "sqlite": sqlite3.sqlite_version,
+        "python": sys.version.split()[0],
+        "persons": len(dimensions.persons),
+        "projects": len(dimensions.projects),
+        "sub_projects": len(dimensions.sub_project_names),
+        "transfers": count_transfer(TransferFilter()),
+        "results": results,
+    }
+
+def parse_args(argv=None):
+    """(options, the arguments left for QApplication)"""
+    parser = argparse.ArgumentParser(description='记账')
+    parser.add_argument('--db', help=f'数据库文件, 默认 {DB_PATH}')
+    parser.add_argument('--drop', action='store_true', help='清空数据库后启动')
+    actions = parser.add_mutually_exclusive_group()
+    actions.add_argument('--check-query-plan', action='store_true', help='检查所有查询计划, 有全表扫描时返回 1')
+    actions.add_argument('--rebuild-balance', action='store_true', help='从流水重建余额')
+    actions.add_argument('--import', dest='import_file', metavar='FILE', help='导入 xlsx 或 csv 流水')
+    actions.add_argument('--verify-balance', action='store_true', help='核对余额, 不一致时返回 1')
+    actions.add_argument('--generate', nargs='+', type=int, metavar='N',
+                         help='TRANSFERS [PERSONS [PROJECTS [SUB_PROJECTS]]], 用生成的数据替换 --db')
+    actions.add_argument('--bench', nargs='?', const='bench.json', metavar='OUT', help='在 --db 上跑基准, 结果写入 OUT')
+    parser.add_argument('--debug', action='store_true', help='显示调试页')
+    parser.add_argument('--startup-check', action='store_true', help='首次绘制后退出, 超过启动预算时返回 1')
+    args, qt_args = parser.parse_known_args(argv)
+    # both replace or load up the database, never the default one by accident
+    if args.generate and not args.db:
+        parser.error('--generate 必须指定 --db')
+    if args.bench and not args.db:
+        parser.error('--bench 必须指定 --db')
+    if args.generate and len(args.generate) > 4:
+        parser.error('--generate 最多 4 个数')
+    return args, qt_args
 
-    app = QApplication(sys.argv)
-    window = LedgerApp()
+if __name__ == "__main__":
+    args, qt_args = parse_args()
+    open_db(args.db or DB_PATH)
+    init_db(args.drop)
+
+    if args.check_query_plan:
+        # every filter combination instead of the quick startup set
+        scans = check_query_plan(True)
+        for name, detail in scans:
+            print(f'[query plan] {name} does a full scan: {detail}')
+        sys.exit(1 if scans else 0)
+
+    for name, detail in check_query_plan():
+        print(f'[query plan] {name} does a full scan: {detail}')
+
+    if args.rebuild_balance:
+        rebuild_balance()
+        sys.exit(0)
+
+    if args.import_file:
+        print(f'imported {import_transfer_file(args.import_file)} transfers')
+        sys.exit(0)
+
+    if args.verify_balance:
+        mismatch = verify_balance()
+        for person_id, sub_project_id, expected, actual in mismatch:
+            print(f'person {person_id} sub_project {sub_project_id}: expected {expected}, got {actual}')
+        sys.exit(1 if mismatch else 0)
+
+    if args.generate:
+        generate_ledger(*args.generate)
+        print(f'generated {count_transfer(TransferFilter())} transfers')
+        sys.exit(0)
+
+    if args.bench:
+        # tabs are loaded headless
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        app = QApplication([sys.argv[0], *qt_args])
+        with open(args.bench, 'w', encoding='utf-8') as f:
+            json.dump(run_benchmarks(app), f, ensure_ascii=False, indent=2)
+        print(f'benchmark results written to {args.bench}')
+        sys.exit(0)
+
+    app = QApplication([sys.argv[0], *qt_args])
+    window = LedgerApp(args.debug)
+    if args.startup_check:
+        # startup regression check: exit as soon as the window has painted,
+        # non-zero when that took longer than STARTUP_BUDGET_MS
+        window.first_painted.connect(lambda ms: app.exit(0 if ms <= STARTUP_BUDGET_MS else 1))
     window.show()
     sys.exit(app.exec())
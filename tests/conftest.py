@@ -0,0 +1,20 @@
+import os
+import pathlib
+import sys
+
+import pytest
+
+# main.py is run as a script, the tests import it from its directory
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'qt_ledger'))
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import main
+
+@pytest.fixture
+def ledger(tmp_path):
+    """main on a fresh database holding a small generated ledger over 2023 and 2024"""
+    main.open_db(str(tmp_path / 'ledger.db'))
+    main.init_db(False)
+    main.generate_ledger(600, persons=3, projects=2, sub_projects=2, start='2023-01-01', days=731)
+    yield main
+    main.db.close()
@@ -0,0 +1,193 @@
+import pytest
+
+import main
+
+# month edges, a leap day and dates before and after every transfer
+DATES = ['2022-12-31', '2023-01-01', '2023-01-31', '2023-02-01', '2023-06-15', '2023-12-31',
+         '2024-02-29', '2024-03-01', '2024-07-01', '2024-12-31', '2099-01-01']
+
+def brute_balance(date):
+    """{(person_id, sub_project_id): (amount, income, spend)} summed straight from transfer"""
+    totals = {}
+    for person_id, sub_project_id, kind, amount in main.cursor.execute(
+            "SELECT person, sub_project, kind, amount FROM transfer WHERE time <= ?", (date,)).fetchall():
+        key = (person_id, sub_project_id)
+        totals[key] = tuple(map(sum, zip(totals.get(key, (0, 0, 0)), main.transfer_delta(kind, amount))))
+    return totals
+
+def nonzero(balance):
+    # a pair whose transfers were all taken out keeps a row of zeros
+    return {key: value for key, value in balance.items() if any(value)}
+
+def assert_invariants():
+    assert main.verify_balance() == []
+    for date in DATES:
+        assert nonzero(main.balance_as_of(date)) == nonzero(brute_balance(date)), date
+
+def state():
+    return [main.cursor.execute(f"SELECT * FROM {table} ORDER BY 1, 2, 3").fetchall()
+            for table in ('transfer', 'balance', 'balance_snapshot')]
+
+def transfer_ids(kind, limit, person_id=None, sub_project_id=None):
+    sql = "SELECT id FROM transfer WHERE kind = ?"
+    params = [kind]
+    if person_id is not None:
+        sql += " AND person = ? AND sub_project = ?"
+        params += [person_id, sub_project_id]
+    return [id_ for (id_,) in main.cursor.execute(sql + " ORDER BY id LIMIT ?", (*params, limit)).fetchall()]
+
+def names(person_id, sub_project_id):
+    return main.cursor.execute("""
+        SELECT person.name, project.name, sub_project.name
+        FROM person, sub_project JOIN project ON sub_project.parent = project.id
+        WHERE person.id = ? AND sub_project.id = ?
+    """, (person_id, sub_project_id)).fetchone()
+
+def test_generated(ledger):
+    assert_invariants()
+
+def test_add_update_delete(ledger):
+    ledger.add_transfer('2023-03-05', '人员1', '项目1', '子项目1', '入账', '12.34', 'back')
+    assert_invariants()
+    id_ = ledger.cursor.execute("SELECT MAX(id) FROM transfer").fetchone()[0]
+    ledger.update_transfer(id_, '2024-08-01', '人员2', '项目2', '子项目1', '入账', '3', 'moved')
+    assert_invariants()
+    ledger.delete_transfer(id_)
+    assert_invariants()
+    ledger.add_transfer('2022-06-01', '人员3', '项目1', '子项目2', '入账', '1', 'before every transfer')
+    assert_invariants()
+
+def test_batch_rewrites(ledger):
+    # earlier income and later spend never take a balance lower
+    assert ledger.shift_transfers(transfer_ids('入账', 60), -45) == 60
+    assert_invariants()
+    assert ledger.shift_transfers(transfer_ids('出账', 30), 40) == 30
+    assert_invariants()
+    assert ledger.delete_transfers(transfer_ids('出账', 30)) == 30
+    assert_invariants()
+    # spend turned into income of another pair raises both
+    assert ledger.reassign_transfers(transfer_ids('出账', 30), '人员1', '项目2', '子项目2', '入账') == 30
+    assert_invariants()
+
+def test_import(ledger):
+    count = ledger.count_transfer(ledger.TransferFilter())
+    rows = [(2, ['2022-11-30', '人员1', '项目1', '子项目1', '入账', '9', 'imported']),
+            (3, ['2023-05-05', '人员2', '项目2', '子项目2', '入账', '7.5', 'imported']),
+            (4, ['2024-12-31', '人员2', '项目2', '子项目2', '出账', '0.5', 'imported']),
+            (5, ['2030-01-01', '人员3', '项目1', '子项目2', '入账', '1', 'imported'])]
+    assert ledger.import_transfers(rows) == 4
+    assert ledger.count_transfer(ledger.TransferFilter()) == count + 4
+    assert_invariants()
+
+def test_import_rejects_non_positive_amount(ledger):
+    before = state()
+    rows = [(2, ['2023-05-05', '人员1', '项目1', '子项目1', '入账', '5', '']),
+            (3, ['2023-05-05', '人员1', '项目1', '子项目1', '出账', '-100', ''])]
+    with pytest.raises(ledger.InvalidInputError, match='第 3 行'):
+        ledger.import_transfers(rows)
+    with pytest.raises(ledger.InvalidInputError):
+        ledger.add_transfer('2023-05-05', '人员1', '项目1', '子项目1', '入账', '0', '')
+    assert state() == before
+
+def test_overdraw_rejected(ledger):
+    person_id, sub_project_id, amount = ledger.cursor.execute(
+        "SELECT person, sub_project, amount FROM balance WHERE amount > 0 ORDER BY amount DESC LIMIT 1").fetchone()
+    person, project, sub_project = names(person_id, sub_project_id)
+    first = ledger.cursor.execute(
+        "SELECT MIN(time) FROM transfer WHERE person = ? AND sub_project = ?", (person_id, sub_project_id)).fetchone()[0]
+    before = state()
+
+    # past the current balance
+    with pytest.raises(ledger.BalanceError):
+        ledger.add_transfer('2024-12-31', person, project, sub_project, '出账', ledger.format_amount(amount + 1), '')
+    # ends at zero but is dated before any income
+    with pytest.raises(ledger.BalanceError):
+        ledger.add_transfer('2022-01-01', person, project, sub_project, '出账', ledger.format_amount(amount), '')
+    assert first > '2022-01-01'
+    # every income of the pair turned into spend
+    with pytest.raises(ledger.BalanceError):
+        ledger.reassign_transfers(transfer_ids('入账', 1000, person_id, sub_project_id), kind='出账')
+    assert state() == before
+    assert_invariants()
+
+def downgrade(version):
+    """turn the open database back into the layout it had at schema version"""
+    execute = main.cursor.execute
+    if version < 10:
+        execute("DROP TABLE balance_snapshot")
+        execute("""
+            CREATE TABLE balance_snapshot (
+                month TEXT NOT NULL, person INTEGER NOT NULL, sub_project INTEGER NOT NULL,
+                amount INTEGER NOT NULL, income INTEGER NOT NULL, spend INTEGER NOT NULL,
+                PRIMARY KEY (month, person, sub_project)
+            ) WITHOUT ROWID
+        """)
+    if version < 9:
+        execute("DROP INDEX transfer_kind_idx")
+    if version < 8:
+        execute("DROP INDEX transfer_pair_time_idx")
+        if version >= 2:
+            execute("CREATE INDEX transfer_person_sub_project_idx ON transfer (person, sub_project)")
+    if version < 7:
+        execute("DROP INDEX project_rank_idx")
+        execute("UPDATE project SET rank = id")
+        execute("UPDATE sub_project SET rank = id")
+    if version < 6:
+        execute("DROP INDEX transfer_list_idx")
+        if version >= 2:
+            execute("CREATE INDEX transfer_list_idx ON transfer (time, person, sub_project, kind, amount, memo)")
+    if version < 5:
+        for trigger in ('transfer_fts_insert', 'transfer_fts_delete', 'transfer_fts_update',
+                        'person_fts_rename', 'project_fts_rename', 'sub_project_fts_rename'):
+            execute(f"DROP TRIGGER {trigger}")
+        execute("DROP TABLE transfer_fts")
+    if version < 4:
+        execute("DROP INDEX transfer_amount_idx")
+    if version < 3:
+        execute("DROP TABLE balance")
+        execute("CREATE TABLE balance (person INTEGER NOT NULL, sub_project INTEGER NOT NULL, amount TEXT NOT NULL, PRIMARY KEY (person, sub_project))")
+    if version < 2:
+        execute("DROP INDEX IF EXISTS transfer_list_idx")
+        execute("DROP INDEX transfer_sub_project_idx")
+        execute("DROP INDEX sub_project_parent_idx")
+    if version < 1:
+        # amounts were decimal text and there was no balance
+        execute("DROP TABLE balance")
+        execute("DROP TABLE balance_snapshot")
+        execute("""
+            CREATE TABLE transfer_text (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                time TEXT NOT NULL,
+                person INTEGER NOT NULL,
+                sub_project INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                amount TEXT NOT NULL,
+                memo TEXT,
+                FOREIGN KEY (person) REFERENCES person(id) ON DELETE RESTRICT,
+                FOREIGN KEY (sub_project) REFERENCES sub_project(id) ON DELETE RESTRICT
+            )
+        """)
+        execute("""
+            INSERT INTO transfer_text
+            SELECT id, time, person, sub_project, kind, (amount / 100) || '.' || printf('%02d', amount % 100), memo
+            FROM transfer
+        """)
+        execute("DROP TABLE transfer")
+        execute("ALTER TABLE transfer_text RENAME TO transfer")
+    execute(f"PRAGMA user_version = {version}")
+    main.conn.commit()
+
+@pytest.mark.parametrize('version', range(main.SCHEMA_VERSION))
+def test_schema_upgrade(ledger, tmp_path, version):
+    before = {date: nonzero(ledger.balance_as_of(date)) for date in DATES}
+    downgrade(version)
+    ledger.open_db(str(tmp_path / 'ledger.db'))
+    ledger.init_db(False)
+    assert ledger.cursor.execute("PRAGMA user_version").fetchone()[0] == ledger.SCHEMA_VERSION
+    assert {date: nonzero(ledger.balance_as_of(date)) for date in DATES} == before
+    assert_invariants()
+    assert ledger.check_query_plan() == []
+    # writes after the upgrade keep balance, snapshots and the text index current
+    ledger.add_transfer('2023-04-01', '人员1', '项目1', '子项目1', '入账', '2', '升级之后')
+    assert_invariants()
+    assert ledger.count_transfer(ledger.TransferFilter(text='升级之后')) == 1
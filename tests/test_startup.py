@@ -0,0 +1,20 @@
+import os
+import pathlib
+import subprocess
+import sys
+
+MAIN = pathlib.Path(__file__).resolve().parent.parent / 'qt_ledger' / 'main.py'
+
+def run_main(*args):
+    # headless, the window still lays out and paints offscreen
+    env = dict(os.environ, QT_QPA_PLATFORM='offscreen')
+    return subprocess.run([sys.executable, str(MAIN), *args], env=env, capture_output=True,
+                          text=True, timeout=300)
+
+def test_startup_within_budget(tmp_path):
+    db = str(tmp_path / 'ledger.db')
+    generated = run_main('--db', db, '--generate', '20000')
+    assert generated.returncode == 0, generated.stdout + generated.stderr
+    # --startup-check exits 1 once the first paint takes longer than STARTUP_BUDGET_MS
+    started = run_main('--db', db, '--startup-check')
+    assert started.returncode == 0, started.stdout + started.stderr